@@ -1,28 +1,246 @@
 import streamlit as st
 import os
+import shutil
 import asyncio
-from memory_manager import store_message#, retrieve_messages
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from memory_manager import store_messages_batch#, retrieve_messages
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from document_loader import load_and_chunk_documents_with_multiple_strategies
-from qdrant_helper import index_document_with_strategies
-from langchain.schema import Document
+from document_loader import load_and_chunk_documents_with_multiple_strategies, build_chunk_strategies, DEFAULT_OVERLAP_RATIO
 from memory_manager import (
     retrieve_context_relevant_messages,
     get_all_session_messages,
-    store_message,
     format_context_messages
 )
-from conversation_aware_rag import (
-    answer_query_with_conversation_context,
-    create_context_message
-)
-
-# Constants
-from qdrant_helper import index_document_with_strategies, query_qdrant_multi_strategy,hybrid_search
-from rag import generate_answer
+from conversation_aware_rag import answer_query_with_conversation_context
+from qdrant_helper import index_document_with_strategies
 from web_crawl import get_scrape_content
 
 
+# Maximum number of chat messages kept in the session for display
+MAX_DISPLAY_MESSAGES = 200
+
+
+# Canned replies for small talk that does not need retrieval
+SMALL_TALK_REPLIES = {
+    "hi": "Hi! Ask me anything about your documents.",
+    "hello": "Hello! Ask me anything about your documents.",
+    "hey": "Hey! Ask me anything about your documents.",
+    "thanks": "You're welcome!",
+    "thank you": "You're welcome!",
+    "ok": "Let me know if you have another question.",
+}
+DEFAULT_SMALL_TALK_REPLY = "Could you ask a more specific question about your documents?"
+
+
+def _small_talk_reply(query):
+    """Return a canned reply for greetings and trivially short queries, or None."""
+    text = query.strip().lower().rstrip("!.?")
+    if text in SMALL_TALK_REPLIES:
+        return SMALL_TALK_REPLIES[text]
+    if len(text) < 4:
+        return DEFAULT_SMALL_TALK_REPLY
+    return None
+
+
+@st.cache_resource
+def _boot():
+    """Run one-time setup and build the constants shared by every rerun."""
+    os.makedirs("data/uploads", exist_ok=True)
+    return {
+        "welcome": SystemMessage(content="Welcome! I'm your RAG assistant. Upload documents or ask questions.")
+    }
+
+
+@st.cache_resource
+def _message_writer():
+    """Start a single background thread that persists chat messages in order.
+
+    Whatever has queued up by the time the thread wakes is stored as one batch
+    per session.
+    """
+    write_queue = queue.Queue()
+
+    def drain():
+        while True:
+            pending = [write_queue.get()]
+            while True:
+                try:
+                    pending.append(write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            by_session = {}
+            for session_id, content, role in pending:
+                by_session.setdefault(session_id, []).append((content, role))
+            for session_id, items in by_session.items():
+                try:
+                    store_messages_batch(session_id, items, wait=False)
+                except Exception as e:
+                    logging.error(f"Error storing {len(items)} messages for session {session_id}: {e}")
+            for _ in pending:
+                write_queue.task_done()
+
+    threading.Thread(target=drain, daemon=True).start()
+    return write_queue
+
+
+@st.cache_resource
+def _event_loop():
+    """Start a long-lived event loop in a background thread for scraping."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_messages(session_id):
+    """Load the stored chat history for a session, cached across reruns."""
+    return get_all_session_messages(session_id)
+
+
+def _answer_query(session_id, query, use_conversation_memory, conversation_weight, document_weight):
+    """Answer a query with the conversation-aware RAG pipeline."""
+    return answer_query_with_conversation_context(
+        session_id=session_id,
+        query=query,
+        use_conversation_memory=use_conversation_memory,
+        conversation_weight=conversation_weight,
+        document_weight=document_weight
+    )
+
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _cached_answer(session_id, query, use_conversation_memory, conversation_weight, document_weight):
+    """Answer a query, reusing the result for repeated identical queries.
+
+    Only safe without conversation memory: with memory on the answer depends on
+    the turns since the last call, which are not part of the cache key.
+    """
+    return _answer_query(session_id, query, use_conversation_memory, conversation_weight, document_weight)
+
+
+def _clear_chat():
+    """Reset the chat state; as a button callback it runs before the single rerun."""
+    st.session_state.messages = deque([_boot()["welcome"]], maxlen=MAX_DISPLAY_MESSAGES)
+    st.session_state.last_retrieved_sources = []
+    st.session_state.last_retrieved_labels = []
+    st.session_state.last_document_sources = []
+    st.session_state.last_conversation_sources = []
+    _load_messages.clear()
+
+
+def _source_labels(sources):
+    """Build the sidebar expander label for each retrieved source once."""
+    labels = []
+    for i, chunk in enumerate(sources):
+        # Handle both structures: nested metadata dict or flattened attributes
+        if "metadata" in chunk:
+            # Original structure with metadata dict
+            source = chunk["metadata"].get("source", "Unknown Source")
+        else:
+            # Flattened structure from MD files
+            source = chunk.get("source", "Unknown Source")
+        labels.append(f"Source {i+1} (Score: {chunk.get('score', 0):.2f}) - {source}")
+    return labels
+
+
+def _process_upload(uploaded_file, collection_name, overlap_ratio=DEFAULT_OVERLAP_RATIO):
+    """Save an uploaded file, chunk it and index the chunks."""
+    file_path = f"data/uploads/{uploaded_file.name}"
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, 1024 * 1024)
+    chunks = load_and_chunk_documents_with_multiple_strategies(file_path, build_chunk_strategies(overlap_ratio))
+    return index_document_with_strategies(collection_name, uploaded_file.name, chunks)
+
+
+@st.fragment
+def _ingestion_sidebar(document_collection):
+    """Render the document upload, settings and URL scraping controls."""
+    st.header("📄 Upload Documents")
+    overlap_ratio = st.slider(
+        "Chunk overlap",
+        min_value=0.0,
+        max_value=0.3,
+        value=DEFAULT_OVERLAP_RATIO,
+        step=0.05,
+        help="Fraction of each chunk shared with its neighbour, so answers spanning a boundary stay retrievable"
+    )
+    # Collect the files in a form so they are indexed together on a single submit
+    with st.form("uploads", clear_on_submit=True):
+        uploaded_files = st.file_uploader("Choose documents", type=["pdf", "docx", "txt"], accept_multiple_files=True)
+        submitted = st.form_submit_button("Index all")
+
+    if submitted and uploaded_files:
+        with st.spinner(f"Processing {len(uploaded_files)} file(s)..."):
+            # Chunk and index the files concurrently, reporting each one as it finishes
+            with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as executor:
+                futures = {
+                    executor.submit(_process_upload, uploaded_file, document_collection, overlap_ratio): uploaded_file
+                    for uploaded_file in uploaded_files
+                }
+                for future in as_completed(futures):
+                    uploaded_file = futures[future]
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        st.error(f"❌ Failed to process {uploaded_file.name}: {str(e)}")
+                        continue
+                    if response["status"] == "success":
+                        st.success(f"✅ Indexed {response['total_chunks']} chunks from {uploaded_file.name}")
+                    else:
+                        st.error(f"❌ Failed: {response['message']}")
+
+    # Add memory toggle in sidebar
+    st.header("⚙️ Settings")
+    st.session_state.use_conversation_memory = st.toggle(
+        "Use conversation memory", 
+        value=st.session_state.use_conversation_memory,
+        help="When enabled, the assistant will use previous conversation context"
+    )
+
+    # Add URL input
+    st.header("Upload URL")
+    url = st.text_input("Enter the URL of the website to scrape")
+
+    # Handle URL input
+    if url:
+        if st.button("Scrape URL"):
+            st.write(f"Scraping {url}...")
+            try:
+                future = asyncio.run_coroutine_threadsafe(get_scrape_content(url), _event_loop())
+                scraped_file = future.result()
+                st.write(f"✅ Scraped content from {url}")
+                chunks = load_and_chunk_documents_with_multiple_strategies(scraped_file, build_chunk_strategies(overlap_ratio))
+
+                response = index_document_with_strategies(document_collection, url, chunks)
+                if response["status"] == "success":
+                    st.success(f"Indexed {response['total_chunks']} chunks for {url}")
+                else:
+                    st.error(f"Failed to index {url}: {response['message']}")
+            except Exception as e:
+                st.error(f"Failed to scrape {url}: {str(e)}")
+
+
+def _sources_panel():
+    """Render the sources retrieved for the last answer."""
+    st.header("Sources")
+    if st.session_state.last_retrieved_sources:
+        for label, chunk in zip(st.session_state.last_retrieved_labels, st.session_state.last_retrieved_sources):
+            with st.expander(label):
+                st.write(chunk.get("text", "No text available"))
+
+
+def _chat_history():
+    """Render the messages kept for display in this session."""
+    for message in st.session_state.messages:
+        with st.chat_message("user" if isinstance(message, HumanMessage) else "assistant"):
+            st.write(message.content)
+
 
 def app():
 
@@ -31,13 +249,16 @@ def app():
 
     # Initialize session state
     if "messages" not in st.session_state:
-        st.session_state.messages = [
-            SystemMessage(content="Welcome! I'm your RAG assistant. Upload documents or ask questions.")
-        ]
-        store_message(SESSION_ID, st.session_state.messages[0].content, "system")
+        st.session_state.messages = deque(_load_messages(SESSION_ID), maxlen=MAX_DISPLAY_MESSAGES)
+        if not st.session_state.messages:
+            st.session_state.messages.append(_boot()["welcome"])
+            _message_writer().put((SESSION_ID, st.session_state.messages[0].content, "system"))
 
     if "last_retrieved_sources" not in st.session_state:
         st.session_state.last_retrieved_sources = []
+        st.session_state.last_retrieved_labels = []
+        st.session_state.last_document_sources = []
+        st.session_state.last_conversation_sources = []
 
     if "use_conversation_memory" not in st.session_state:
         st.session_state.use_conversation_memory = True
@@ -48,53 +269,11 @@ def app():
     # Create a two-column layout
     col1, col2 = st.columns([2, 1])
 
-    # Settings sidebar
+    # Upload, scrape and settings controls rerun as a fragment, so interacting with
+    # them does not re-render the chat history and source panels
     with st.sidebar:
-        st.header("📄 Upload Documents")
-        uploaded_files = st.file_uploader("Choose documents", type=["pdf", "docx", "txt"], accept_multiple_files=True)
-
-        if uploaded_files:
-            os.makedirs("data/uploads", exist_ok=True)
-            for uploaded_file in uploaded_files:
-                file_path = f"data/uploads/{uploaded_file.name}"
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                with st.spinner(f"Processing {uploaded_file.name}..."):
-                    chunks = load_and_chunk_documents_with_multiple_strategies(file_path)
-                    response = index_document_with_strategies(DOCUMENT_COLLECTION, uploaded_file.name, chunks)
-                    if response["status"] == "success":
-                        st.success(f"✅ Indexed {sum(len(v) for v in chunks.values())} chunks")
-                    else:
-                        st.error(f"❌ Failed: {response['message']}")
-
-        # Add memory toggle in sidebar
-        st.header("⚙️ Settings")
-        st.session_state.use_conversation_memory = st.toggle(
-            "Use conversation memory", 
-            value=st.session_state.use_conversation_memory,
-            help="When enabled, the assistant will use previous conversation context"
-        )
-
-    # Add sidebar for URL input
-    st.sidebar.header("Upload URL")
-    url = st.sidebar.text_input("Enter the URL of the website to scrape")
+        _ingestion_sidebar(DOCUMENT_COLLECTION)
 
-    # Handle URL input
-    if url:
-        if st.sidebar.button("Scrape URL"):
-            st.sidebar.write(f"Scraping {url}...")
-            try:
-                scraped_file = asyncio.run(get_scrape_content(url))  # Assuming this function returns the scraped text
-                st.sidebar.write(f"✅ Scraped content from {url}")
-                chunks = load_and_chunk_documents_with_multiple_strategies(scraped_file)
-
-                response = index_document_with_strategies(DOCUMENT_COLLECTION, url, chunks)
-                if response["status"] == "success":
-                    st.sidebar.success(f"Indexed {len(chunks)} chunks for {url}")
-                else:
-                    st.sidebar.error(f"Failed to index {url}: {response['message']}")
-            except Exception as e:
-                st.sidebar.error(f"Failed to scrape {url}: {str(e)}")
     # Left sidebar for showing sources
     # with st.sidebar:
     #     st.header("Sources")
@@ -108,30 +287,12 @@ def app():
     #         st.write("No sources to display. Ask a question to see relevant sources.")
 
     with st.sidebar:
-        st.header("Sources")
-        if st.session_state.last_retrieved_sources:
-            for i, chunk in enumerate(st.session_state.last_retrieved_sources):
-                # Handle both structures: nested metadata dict or flattened attributes
-                if "metadata" in chunk:
-                    # Original structure with metadata dict
-                    source = chunk["metadata"].get("source", "Unknown Source")
-                else:
-                    # Flattened structure from MD files
-                    source = chunk.get("source", "Unknown Source")
-
-                score = chunk.get("score", "N/A")
-                with st.expander(f"Source {i+1} (Score: {score:.2f}) - {source}"):
-                    st.write(chunk.get("text", "No text available"))
+        _sources_panel()
 
     # Main chat area (left column)
     with col1:
         # Display chat messages
-        for message in st.session_state.messages:
-            if isinstance(message, SystemMessage) and "Use the following context" in message.content:
-                # Skip displaying context messages
-                continue
-            with st.chat_message("user" if isinstance(message, HumanMessage) else "assistant"):
-                st.write(message.content)
+        _chat_history()
 
         # Chat input
         query = st.chat_input("Ask a question about your documents...")
@@ -140,58 +301,64 @@ def app():
                 st.write(query)
 
             st.session_state.messages.append(HumanMessage(content=query))
-            store_message(SESSION_ID, query, "user")
+            _message_writer().put((SESSION_ID, query, "user"))
 
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    response = answer_query_with_conversation_context(
-                        session_id=SESSION_ID,
-                        query=query,
-                        use_conversation_memory=st.session_state.use_conversation_memory,
-                        conversation_weight=0.3,  # Default weights
-                        document_weight=0.7
-                    )
-
-                    st.session_state.last_retrieved_sources = response.get("sources", [])
-                    if response.get("sources"):
-                        st.session_state.messages.append(create_context_message(response["sources"]))
-
-                    st.write(response["answer"])
-                    st.session_state.messages.append(AIMessage(content=response["answer"]))
-                    store_message(SESSION_ID, response["answer"], "assistant")
+                # Small talk is answered locally without retrieval or generation
+                answer = _small_talk_reply(query)
+                if answer is None:
+                    with st.spinner("Thinking..."):
+                        # Follow-ups depend on the conversation so far, so they are always generated fresh
+                        answer_fn = _answer_query if st.session_state.use_conversation_memory else _cached_answer
+                        response = answer_fn(
+                            session_id=SESSION_ID,
+                            query=query,
+                            use_conversation_memory=st.session_state.use_conversation_memory,
+                            conversation_weight=0.3,  # Default weights
+                            document_weight=0.7
+                        )
+
+                        # Context is already part of the LLM call, so it is not kept in the display history
+                        st.session_state.last_retrieved_sources = response.get("sources", [])
+                        st.session_state.last_retrieved_labels = _source_labels(st.session_state.last_retrieved_sources)
+                        st.session_state.last_document_sources = response.get("document_sources", [])
+                        st.session_state.last_conversation_sources = response.get("conversation_sources", [])
+                        answer = response["answer"]
+
+                st.write(answer)
+                st.session_state.messages.append(AIMessage(content=answer))
+                _message_writer().put((SESSION_ID, answer, "assistant"))
 
         # Clear chat history button (in main column)
-        if st.button("Clear Chat History"):
-            st.session_state.messages = [SystemMessage(content="Welcome! I'm your RAG assistant. Upload documents or ask questions.")]
-            st.session_state.last_retrieved_sources = []
-            st.rerun()
+        st.button("Clear Chat History", on_click=_clear_chat)
 
     # Source panel (right column)
     with col2:
         st.header("📑 Referenced Sources")
 
         if st.session_state.last_retrieved_sources:
-            # Group sources by type
-            document_sources = [s for s in st.session_state.last_retrieved_sources if s["type"] == "document"]
-            conversation_sources = [s for s in st.session_state.last_retrieved_sources if s["type"] == "conversation"]
+            # Sources arrive already grouped by type
+            document_sources = st.session_state.last_document_sources
+            conversation_sources = st.session_state.last_conversation_sources
 
             # Display document sources
             if document_sources:
                 st.subheader("Document Chunks")
-                for i, source in enumerate(document_sources):
-                    with st.expander(f"Chunk {i+1} (Score: {source['score']:.2f})"):
+                titles = [f"Chunk {i+1} (Score: {s['score']:.2f})" for i, s in enumerate(document_sources)]
+                for title, source in zip(titles, document_sources):
+                    with st.expander(title):
                         st.markdown(f"**Strategy:** {source.get('strategy', 'Unknown')}")
 
                         # Display metadata if available
                         if source.get("metadata"):
                             meta = source["metadata"]
-                            meta_text = ""
+                            meta_parts = []
                             if meta.get("page"):
-                                meta_text += f"**Page:** {meta['page']}"
+                                meta_parts.append(f"**Page:** {meta['page']}")
                             if meta.get("source"):
-                                meta_text += f" | **Source:** {meta['source']}"
-                            if meta_text:
-                                st.markdown(meta_text)
+                                meta_parts.append(f"**Source:** {meta['source']}")
+                            if meta_parts:
+                                st.markdown(" | ".join(meta_parts))
 
                         # Display chunk text
                         st.markdown("---")
@@ -1,9 +1,14 @@
 import streamlit as st
 import os
+import shutil
 import asyncio
 import bcrypt
 import uuid
-import json
+import hashlib
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from memory_manager import store_message
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
@@ -23,83 +28,170 @@ from conversation_aware_rag import (
 from qdrant_helper import index_document_with_strategies, query_qdrant_multi_strategy, hybrid_search
 from rag import generate_answer
 from web_crawl import get_scrape_content
+import db
 
 # User authentication constants
-USER_DB_FILE = "user_database.json"
 SESSION_DURATION = timedelta(hours=24)
+BCRYPT_TARGET_SECONDS = 0.25
+VERIFY_CACHE_TTL = 60  # seconds
+VERIFY_CACHE_MAX_ENTRIES = 1024
+LOGIN_MAX_FAILURES = 5
+LOGIN_FAILURE_WINDOW = 60  # seconds
+LOGIN_FAILURE_MAX_KEYS = 4096
+# Reverse proxies whose X-Forwarded-For entries are trusted, as comma-separated
+# addresses; empty means the app is reached directly and the header is ignored
+TRUSTED_PROXIES = frozenset(filter(None, (p.strip() for p in os.getenv("TRUSTED_PROXIES", "").split(","))))
 
-# Initialize user database if it doesn't exist
-def init_user_db():
-    if not os.path.exists(USER_DB_FILE):
-        with open(USER_DB_FILE, "w") as f:
-            json.dump({"users": {}}, f)
-        return {"users": {}}
-    
-    with open(USER_DB_FILE, "r") as f:
-        return json.load(f)
+# In-process cache of recent bcrypt results: (stored hash, sha256 of attempt) -> (ok, checked_at).
+# Held in st.cache_resource because this script's globals are rebuilt on every rerun.
+@st.cache_resource
+def _verify_cache():
+    return {}
+
+# Pick the highest bcrypt cost whose hash stays within the target time on this
+# host; the floor keeps slow hosts at a sane minimum. Cached so the calibration
+# runs once per process rather than on every script rerun.
+@st.cache_resource
+def calibrate_bcrypt_rounds(target_seconds=BCRYPT_TARGET_SECONDS, min_rounds=10, max_rounds=14):
+    rounds = min_rounds
+    for candidate in range(min_rounds, max_rounds + 1):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds=candidate))
+        if time.perf_counter() - start > target_seconds:
+            break
+        rounds = candidate
+    return rounds
 
-# Save user database
-def save_user_db(db):
-    with open(USER_DB_FILE, "w") as f:
-        json.dump(db, f)
+# Hash checked when the username is unknown, so a failed login takes as long
+# whether or not the account exists
+@st.cache_resource
+def _dummy_password_hash():
+    return bcrypt.hashpw(b"no-such-user", bcrypt.gensalt(rounds=calibrate_bcrypt_rounds()))
 
 # Hash password
 def hash_password(password):
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=calibrate_bcrypt_rounds())
     hashed = bcrypt.hashpw(password.encode(), salt)
     return hashed.decode()
 
-# Verify password
+# Verify password, reusing a recent bcrypt result for the same attempt so
+# reruns don't pay the full KDF cost again
 def verify_password(stored_password, provided_password):
-    return bcrypt.checkpw(provided_password.encode(), stored_password.encode())
+    key = (stored_password, hashlib.sha256(provided_password.encode()).digest())
+    now = time.monotonic()
+    verify_cache = _verify_cache()
+    cached = verify_cache.get(key)
+    if cached is not None and now - cached[1] < VERIFY_CACHE_TTL:
+        return cached[0]
+    
+    result = bcrypt.checkpw(provided_password.encode(), stored_password.encode())
+    if len(verify_cache) >= VERIFY_CACHE_MAX_ENTRIES:
+        verify_cache.clear()
+    verify_cache[key] = (result, now)
+    return result
+
+# Sessions are stored by the SHA-256 of their id, so a lookup can't leak a
+# prefix of a live token through timing and a copy of the DB holds no usable ids
+def hash_session_id(session_id):
+    return hashlib.sha256(session_id.encode()).hexdigest()
 
 # Create new user
 def create_user(username, password, email):
-    db = init_user_db()
-    
-    if username in db["users"]:
-        return False, "Username already exists"
-    
-    # Check for existing email
-    for user_data in db["users"].values():
-        if user_data.get("email") == email:
-            return False, "Email already registered"
+    # One probe of the username and email unique indexes
+    existing = db.fetch_one(
+        "SELECT username FROM users WHERE username = ? OR email = ? "
+        "ORDER BY username = ? DESC LIMIT 1",
+        (username, email, username)
+    )
+    if existing is not None:
+        if existing["username"] == username:
+            return False, "Username already exists"
+        return False, "Email already registered"
     
     hashed_password = hash_password(password)
     
-    db["users"][username] = {
-        "password": hashed_password,
-        "email": email,
-        "created_at": datetime.now().isoformat(),
-        "documents": []  # Track user's documents
-    }
-    
-    save_user_db(db)
+    # A concurrent signup can take the name or email after the check above;
+    # the unique constraints catch it
+    try:
+        db.execute(
+            "INSERT INTO users (username, password, email, created_at) VALUES (?, ?, ?, ?)",
+            (username, hashed_password, email, datetime.now().isoformat())
+        )
+    except sqlite3.IntegrityError:
+        if db.fetch_one("SELECT 1 FROM users WHERE username = ?", (username,)):
+            return False, "Username already exists"
+        return False, "Email already registered"
     return True, "User created successfully"
 
+# Recent failed logins: (username, client) -> (failures, window_start),
+# ordered from least to most recently failed
+@st.cache_resource
+def _login_failures():
+    return OrderedDict()
+
+# Identify the client making the request, so one client's failures can't lock
+# the account for everyone else. This is the peer address; X-Forwarded-For is
+# client-controlled, so it is only read when the peer is a trusted proxy, and
+# then the rightmost hop that isn't itself a trusted proxy is the client.
+def get_client_id():
+    peer = getattr(st.context, "ip_address", None) or "unknown"
+    if peer not in TRUSTED_PROXIES:
+        return peer
+    forwarded = st.context.headers.get("X-Forwarded-For", "")
+    for hop in reversed([h.strip() for h in forwarded.split(",") if h.strip()]):
+        if hop not in TRUSTED_PROXIES:
+            return hop
+    return peer
+
+# Record a failed login; the count restarts once its window has passed
+def record_login_failure(username, client_id):
+    failures = _login_failures()
+    now = time.monotonic()
+    key = (username, client_id)
+    if key not in failures:
+        # Make room by evicting the least recently failed keys, one at a time,
+        # so a flood of new keys can't wipe the lockouts still in force
+        while len(failures) >= LOGIN_FAILURE_MAX_KEYS:
+            failures.popitem(last=False)
+    count, window_start = failures.get(key, (0, now))
+    if now - window_start > LOGIN_FAILURE_WINDOW:
+        count, window_start = 0, now
+    failures[key] = (count + 1, window_start)
+    failures.move_to_end(key)
+
+def is_login_throttled(username, client_id):
+    count, window_start = _login_failures().get((username, client_id), (0, 0.0))
+    return count >= LOGIN_MAX_FAILURES and time.monotonic() - window_start <= LOGIN_FAILURE_WINDOW
+
 # Authenticate user
 def authenticate_user(username, password):
-    db = init_user_db()
+    # Refuse before any lookup or bcrypt work once this client has too many
+    # failures against the account
+    client_id = get_client_id()
+    if is_login_throttled(username, client_id):
+        return False, "Too many attempts, try again later"
+    
+    user = db.fetch_one("SELECT password FROM users WHERE username = ?", (username,))
     
-    if username not in db["users"]:
+    # Unknown usernames are not tracked, so guesses can't grow the failure store
+    if user is None:
+        bcrypt.checkpw(password.encode(), _dummy_password_hash())
         return False, "Invalid username or password"
     
-    if not verify_password(db["users"][username]["password"], password):
+    if not verify_password(user["password"], password):
+        record_login_failure(username, client_id)
         return False, "Invalid username or password"
     
+    _login_failures().pop((username, client_id), None)
+    
     # Create session
     session_id = str(uuid.uuid4())
     expiry = (datetime.now() + SESSION_DURATION).isoformat()
     
-    if "sessions" not in db:
-        db["sessions"] = {}
-    
-    db["sessions"][session_id] = {
-        "username": username,
-        "expires": expiry
-    }
-    
-    save_user_db(db)
+    db.execute(
+        "INSERT INTO sessions (sid, username, expires) VALUES (?, ?, ?)",
+        (hash_session_id(session_id), username, expiry)
+    )
     return True, session_id
 
 # Validate session
@@ -107,32 +199,68 @@ def validate_session(session_id):
     if not session_id:
         return False, None
     
-    db = init_user_db()
+    hashed_id = hash_session_id(session_id)
+    session = db.fetch_one("SELECT username, expires FROM sessions WHERE sid = ?", (hashed_id,))
     
-    if "sessions" not in db or session_id not in db["sessions"]:
+    if session is None:
         return False, None
     
-    session = db["sessions"][session_id]
     expiry = datetime.fromisoformat(session["expires"])
     
     if datetime.now() > expiry:
         # Session expired
-        del db["sessions"][session_id]
-        save_user_db(db)
+        db.execute("DELETE FROM sessions WHERE sid = ?", (hashed_id,))
         return False, None
     
     return True, session["username"]
 
 # Logout user
 def logout_user(session_id):
-    db = init_user_db()
-    
-    if "sessions" in db and session_id in db["sessions"]:
-        del db["sessions"][session_id]
-        save_user_db(db)
-        return True
+    if not session_id:
+        return False
     
-    return False
+    cursor = db.execute("DELETE FROM sessions WHERE sid = ?", (hash_session_id(session_id),))
+    return cursor.rowcount > 0
+
+# Long-lived event loop on a background thread; scrapes run on it so the
+# shared crawler in web_crawl stays bound to one loop across reruns
+@st.cache_resource
+def _event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# In-process copy of each user's document list. This process is the only
+# writer, so the list is loaded once and kept in step by add_user_document.
+@st.cache_resource
+def _user_documents():
+    return {}
+
+# Track documents or URLs in the user's profile with a single batched write
+def add_user_documents(username, new_docs):
+    docs = get_user_documents(username)
+    added = [doc for doc in dict.fromkeys(new_docs) if doc not in docs]
+    if not added:
+        return
+    db.execute_many(
+        "INSERT OR IGNORE INTO user_documents (username, doc) VALUES (?, ?)",
+        [(username, doc) for doc in added]
+    )
+    docs.extend(added)
+
+def add_user_document(username, doc):
+    add_user_documents(username, [doc])
+
+# List the user's documents in the order they were added
+def get_user_documents(username):
+    user_documents = _user_documents()
+    if username not in user_documents:
+        rows = db.fetch_all(
+            "SELECT doc FROM user_documents WHERE username = ? ORDER BY rowid",
+            (username,)
+        )
+        user_documents[username] = [row["doc"] for row in rows]
+    return user_documents[username]
 
 # Initialize session state for authentication
 def init_auth_state():
@@ -204,6 +332,19 @@ def show_login_page():
 def get_user_session_id():
     return f"{st.session_state.username}_{SESSION_ID}"
 
+# Chat history: `messages` keeps everything (including context messages), while
+# `visible_messages` holds only the (role, content) pairs the chat area renders
+def reset_chat_messages():
+    welcome = SystemMessage(content=f"Welcome {st.session_state.username}! I'm your RAG assistant. Upload documents or ask questions.")
+    st.session_state.messages = [welcome]
+    st.session_state.visible_messages = [("assistant", welcome.content)]
+    return welcome
+
+def add_chat_message(message, role=None):
+    st.session_state.messages.append(message)
+    if role is not None:
+        st.session_state.visible_messages.append((role, message.content))
+
 # Main application
 def show_main_app():
     # Create user-specific document collection
@@ -211,13 +352,13 @@ def show_main_app():
     
     # Initialize session state for chat
     if "messages" not in st.session_state:
-        st.session_state.messages = [
-            SystemMessage(content=f"Welcome {st.session_state.username}! I'm your RAG assistant. Upload documents or ask questions.")
-        ]
-        store_message(get_user_session_id(), st.session_state.messages[0].content, "system")
+        welcome = reset_chat_messages()
+        store_message(get_user_session_id(), welcome.content, "system")
 
     if "last_retrieved_sources" not in st.session_state:
         st.session_state.last_retrieved_sources = []
+        st.session_state.last_document_sources = []
+        st.session_state.last_conversation_sources = []
 
     if "use_conversation_memory" not in st.session_state:
         st.session_state.use_conversation_memory = True
@@ -246,24 +387,25 @@ def show_main_app():
             user_upload_dir = f"uploads/{st.session_state.username}"
             os.makedirs(user_upload_dir, exist_ok=True)
             
+            indexed_files = []
             for uploaded_file in uploaded_files:
                 file_path = f"{user_upload_dir}/{uploaded_file.name}"
+                uploaded_file.seek(0)
                 with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
+                    shutil.copyfileobj(uploaded_file, f, 1024 * 1024)
                 with st.spinner(f"Processing {uploaded_file.name}..."):
                     chunks = load_and_chunk_documents_with_multiple_strategies(file_path)
                     response = index_document_with_strategies(user_document_collection, uploaded_file.name, chunks)
                     
-                    # Track document in user profile
-                    db = init_user_db()
-                    if uploaded_file.name not in db["users"][st.session_state.username]["documents"]:
-                        db["users"][st.session_state.username]["documents"].append(uploaded_file.name)
-                        save_user_db(db)
+                    indexed_files.append(uploaded_file.name)
                     
                     if response["status"] == "success":
-                        st.success(f"✅ Indexed {sum(len(v) for v in chunks.values())} chunks")
+                        st.success(f"✅ Indexed {response['total_chunks']} chunks")
                     else:
                         st.error(f"❌ Failed: {response['message']}")
+            
+            # Track all processed documents in the user profile at once
+            add_user_documents(st.session_state.username, indexed_files)
         
         # Add memory toggle in sidebar
         st.header("⚙ Settings")
@@ -286,20 +428,20 @@ def show_main_app():
                 user_scrape_dir = f"scraped/{st.session_state.username}"
                 os.makedirs(user_scrape_dir, exist_ok=True)
                 
-                scraped_file = asyncio.run(get_scrape_content(url, output_dir=user_scrape_dir))
+                future = asyncio.run_coroutine_threadsafe(
+                    get_scrape_content(url, output_dir=user_scrape_dir), _event_loop()
+                )
+                scraped_file = future.result()
                 st.sidebar.write(f"✅ Scraped content from {url}")
                 chunks = load_and_chunk_documents_with_multiple_strategies(scraped_file)
                         
                 response = index_document_with_strategies(user_document_collection, url, chunks)
                 
                 # Track scraped URL in user profile
-                db = init_user_db()
-                if url not in db["users"][st.session_state.username]["documents"]:
-                    db["users"][st.session_state.username]["documents"].append(url)
-                    save_user_db(db)
+                add_user_document(st.session_state.username, url)
                 
                 if response["status"] == "success":
-                    st.sidebar.success(f"Indexed {sum(len(v) for v in chunks.values())} chunks for {url}")
+                    st.sidebar.success(f"Indexed {response['total_chunks']} chunks for {url}")
                 else:
                     st.sidebar.error(f"Failed to index {url}: {response['message']}")
             except Exception as e:
@@ -308,8 +450,7 @@ def show_main_app():
     # Display user documents
     with st.sidebar:
         st.header("Your Documents")
-        db = init_user_db()
-        user_docs = db["users"][st.session_state.username]["documents"]
+        user_docs = get_user_documents(st.session_state.username)
         
         if user_docs:
             for doc in user_docs:
@@ -336,12 +477,9 @@ def show_main_app():
     # Main chat area (left column)
     with col1:
         # Display chat messages
-        for message in st.session_state.messages:
-            if isinstance(message, SystemMessage) and "Use the following context" in message.content:
-                # Skip displaying context messages
-                continue
-            with st.chat_message("user" if isinstance(message, HumanMessage) else "assistant"):
-                st.write(message.content)
+        for role, content in st.session_state.visible_messages:
+            with st.chat_message(role):
+                st.write(content)
 
         # Chat input
         query = st.chat_input("Ask a question about your documents...")
@@ -349,7 +487,7 @@ def show_main_app():
             with st.chat_message("user"):
                 st.write(query)
             
-            st.session_state.messages.append(HumanMessage(content=query))
+            add_chat_message(HumanMessage(content=query), "user")
             store_message(get_user_session_id(), query, "user")
             
             with st.chat_message("assistant"):
@@ -364,17 +502,24 @@ def show_main_app():
                     )
                     
                     st.session_state.last_retrieved_sources = response.get("sources", [])
+                    st.session_state.last_document_sources = response.get("document_sources", [])
+                    st.session_state.last_conversation_sources = response.get("conversation_sources", [])
                     if response.get("sources"):
-                        st.session_state.messages.append(create_context_message(response["sources"]))
+                        # Context messages are kept in history but never displayed
+                        add_chat_message(create_context_message(
+                            response["document_sources"], response["conversation_sources"]
+                        ))
                    
                     st.write(response["answer"])
-                    st.session_state.messages.append(AIMessage(content=response["answer"]))
+                    add_chat_message(AIMessage(content=response["answer"]), "assistant")
                     store_message(get_user_session_id(), response["answer"], "assistant")
 
         # Clear chat history button (in main column)
         if st.button("Clear Chat History"):
-            st.session_state.messages = [SystemMessage(content=f"Welcome {st.session_state.username}! I'm your RAG assistant. Upload documents or ask questions.")]
+            reset_chat_messages()
             st.session_state.last_retrieved_sources = []
+            st.session_state.last_document_sources = []
+            st.session_state.last_conversation_sources = []
             st.rerun()
 
     # Source panel (right column)
@@ -382,27 +527,28 @@ def show_main_app():
         st.header("📑 Referenced Sources")
         
         if st.session_state.last_retrieved_sources:
-            # Group sources by type
-            document_sources = [s for s in st.session_state.last_retrieved_sources if s["type"] == "document"]
-            conversation_sources = [s for s in st.session_state.last_retrieved_sources if s["type"] == "conversation"]
+            # Sources arrive already grouped by type
+            document_sources = st.session_state.last_document_sources
+            conversation_sources = st.session_state.last_conversation_sources
             
             # Display document sources
             if document_sources:
                 st.subheader("Document Chunks")
-                for i, source in enumerate(document_sources):
-                    with st.expander(f"Chunk {i+1} (Score: {source['score']:.2f})"):
+                titles = [f"Chunk {i+1} (Score: {s['score']:.2f})" for i, s in enumerate(document_sources)]
+                for title, source in zip(titles, document_sources):
+                    with st.expander(title):
                         st.markdown(f"*Strategy:* {source.get('strategy', 'Unknown')}")
                         
                         # Display metadata if available
                         if source.get("metadata"):
                             meta = source["metadata"]
-                            meta_text = ""
+                            meta_parts = []
                             if meta.get("page"):
-                                meta_text += f"*Page:* {meta['page']}"
+                                meta_parts.append(f"*Page:* {meta['page']}")
                             if meta.get("source"):
-                                meta_text += f" | *Source:* {meta['source']}"
-                            if meta_text:
-                                st.markdown(meta_text)
+                                meta_parts.append(f"*Source:* {meta['source']}")
+                            if meta_parts:
+                                st.markdown(" | ".join(meta_parts))
                         
                         # Display chunk text
                         st.markdown("---")
@@ -8,10 +8,14 @@ def query_or_respond(state: MessagesState, llm_with_tools, retrieve_tool):
     return {"messages": [response]}
 
 def generate_response(state: MessagesState, llm):
-    recent_tool_messages = [
-        message for message in reversed(state["messages"])
-        if message.type == "tool"
-    ][::-1]
+    # The latest tool run is the tail of the history, so walk back only until the
+    # first non-tool message instead of filtering the whole conversation
+    recent_tool_messages = []
+    for message in reversed(state["messages"]):
+        if message.type != "tool":
+            break
+        recent_tool_messages.append(message)
+    recent_tool_messages.reverse()
 
     docs_content = "\n\n".join(doc.content for doc in recent_tool_messages)
     system_message_content = (
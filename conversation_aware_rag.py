@@ -1,4 +1,7 @@
+import io
 import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any
 from langchain_core.messages import SystemMessage
 from memory_manager import (
@@ -39,61 +42,72 @@ def answer_query_with_conversation_context(
         
     Returns:
         Dict containing the answer and source information
+        
+    The query and answer are not written to conversation memory here; callers
+    store each turn themselves.
     """
-    # Store the current query
-    store_message(session_id, query, "user")
-    
     # Initialize contexts
     document_context = ""
     conversation_context = ""
-    all_sources = []
-    
-    # 1. Get document context from RAG
-    logger.info(f"Retrieving document context for query: {query}")
-    document_chunks = hybrid_search(
-        collection_name=DOCUMENT_COLLECTION,
-        query_text=query,
-        top_k=top_k_docs
-    )
+    document_sources = []
+    conversation_sources = []
+    relevant_messages = []
+    
+    # The document search runs on a worker thread while this thread searches the
+    # conversation, so the Qdrant round-trips overlap
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        logger.info(f"Retrieving document context for query: {query}")
+        document_future = executor.submit(
+            hybrid_search,
+            collection_name=DOCUMENT_COLLECTION,
+            query_text=query,
+            top_k=top_k_docs
+        )
+        
+        if use_conversation_memory:
+            logger.info(f"Retrieving conversation context for query: {query}")
+            relevant_messages = retrieve_context_relevant_messages(
+                session_id=session_id,
+                query=query,
+                context_window=2,
+                top_k=top_k_conversations
+            )
+        
+        document_chunks = document_future.result()
     
+    # 1. Build document context from RAG results
     if document_chunks:
-        # Remove duplicates while preserving order
-        unique_texts = {}
+        # Remove duplicates while preserving order, keeping the first (best-ranked) copy
+        seen = set()
+        buf = io.StringIO()
         for chunk in document_chunks:
-            unique_texts[chunk["text"]] = chunk
-        unique_chunks = list(unique_texts.values())
+            if chunk["text"] not in seen:
+                seen.add(chunk["text"])
+                document_sources.append({
+                    "type": "document",
+                    "text": chunk["text"],
+                    "metadata": chunk.get("metadata", {}),
+                    "score": chunk.get("score", 0),
+                    "strategy": chunk.get("strategy", "unknown")
+                })
+                buf.write(chunk["text"])
+                buf.write(" ")
         
-        document_context = " ".join([chunk["text"] for chunk in unique_chunks])
-        all_sources.extend([{
-            "type": "document",
-            "text": chunk["text"],
-            "metadata": chunk.get("metadata", {}),
-            "score": chunk.get("score", 0),
-            "strategy": chunk.get("strategy", "unknown")
-        } for chunk in unique_chunks])
+        document_context = buf.getvalue().rstrip()
         
-        logger.info(f"Retrieved {len(unique_chunks)} unique document chunks")
-    
-    # 2. Get conversation context if enabled
-    if use_conversation_memory:
-        logger.info(f"Retrieving conversation context for query: {query}")
-        relevant_messages = retrieve_context_relevant_messages(
-            session_id=session_id,
-            query=query,
-            context_window=2,
-            top_k=top_k_conversations
-        )
+        logger.info(f"Retrieved {len(document_sources)} unique document chunks")
+    
+    # 2. Build conversation context if enabled
+    if relevant_messages:
+        conversation_context = format_context_messages(relevant_messages)
+        conversation_sources.extend({
+            "type": "conversation",
+            "text": msg.content,
+            "role": msg.type,
+            "score": 1.0  # Default score for conversation context
+        } for msg in relevant_messages)
         
-        if relevant_messages:
-            conversation_context = format_context_messages(relevant_messages)
-            all_sources.extend([{
-                "type": "conversation",
-                "text": msg.content,
-                "role": msg.type,
-                "score": 1.0  # Default score for conversation context
-            } for msg in relevant_messages])
-            
-            logger.info(f"Retrieved {len(relevant_messages)} relevant conversation messages")
+        logger.info(f"Retrieved {len(relevant_messages)} relevant conversation messages")
     
     # 3. Combine contexts with weighting
     if not document_context and not conversation_context:
@@ -107,58 +121,75 @@ def answer_query_with_conversation_context(
             conversation_weight = conversation_weight / total_weight
         
         # Prepare final context with appropriate weighting
-        sections = []
+        buf = io.StringIO()
         if document_context:
-            sections.append(f"Document Context ({document_weight*100:.0f}% weight):\n{document_context}")
+            buf.write(f"Document Context ({document_weight*100:.0f}% weight):\n")
+            buf.write(document_context)
         if conversation_context:
-            sections.append(f"Conversation Context ({conversation_weight*100:.0f}% weight):\n{conversation_context}")
+            if document_context:
+                buf.write("\n\n")
+            buf.write(f"Conversation Context ({conversation_weight*100:.0f}% weight):\n")
+            buf.write(conversation_context)
         
-        combined_context = "\n\n".join(sections)
+        combined_context = buf.getvalue()
         
         # 4. Generate answer using combined context
         logger.info("Generating answer using combined context")
         answer = generate_answer(query, combined_context)
     
-    # 5. Store the response
-    store_message(session_id, answer, "assistant")
-    
-    # Return the results
+    # Return the results; sources are also handed back already split by type
     return {
         "answer": answer,
-        "sources": all_sources,
+        "sources": document_sources + conversation_sources,
+        "document_sources": document_sources,
+        "conversation_sources": conversation_sources,
         "document_context_used": bool(document_context),
         "conversation_context_used": bool(conversation_context)
     }
 
-def create_context_message(context_sources):
+def create_context_message(document_sources, conversation_sources):
     """
     Create a system message containing context information.
     
     Args:
-        context_sources: List of context source dictionaries
+        document_sources: List of document source dictionaries
+        conversation_sources: List of conversation source dictionaries
         
     Returns:
         SystemMessage with formatted context
     """
-    document_sources = [s for s in context_sources if s["type"] == "document"]
-    conversation_sources = [s for s in context_sources if s["type"] == "conversation"]
-    
-    context_parts = []
+    # Each caller gets its own message; only the formatted text is shared
+    return SystemMessage(content=_build_context_text(
+        tuple(s["text"] for s in document_sources),
+        tuple((s["role"], s["text"]) for s in conversation_sources)
+    ))
+
+@lru_cache(maxsize=32)
+def _build_context_text(document_texts, conversation_turns):
+    """Format the context text, memoized so a repeated retrieval result (for
+    example a rerun of the same query) is not formatted again."""
+    buf = io.StringIO()
+    buf.write("Use the following context to answer the question:\n\n")
     
     # Add document context
-    if document_sources:
-        doc_texts = [f"- {s['text']}" for s in document_sources]
-        context_parts.append("Document Context:\n" + "\n".join(doc_texts))
+    if document_texts:
+        buf.write("Document Context:")
+        for text in document_texts:
+            buf.write("\n- ")
+            buf.write(text)
     
     # Add conversation context
-    if conversation_sources:
-        convo_texts = []
-        for s in conversation_sources:
-            role = s["role"].capitalize()
-            convo_texts.append(f"- {role}: {s['text']}")
-        
-        context_parts.append("Conversation Context:\n" + "\n".join(convo_texts))
-    return SystemMessage(content="Use the following context to answer the question:\n\n" + "\n\n".join(context_parts))
+    if conversation_turns:
+        if document_texts:
+            buf.write("\n\n")
+        buf.write("Conversation Context:")
+        for role, text in conversation_turns:
+            buf.write("\n- ")
+            buf.write(role.capitalize())
+            buf.write(": ")
+            buf.write(text)
+    
+    return buf.getvalue()
     
 import argparse
 
@@ -177,6 +208,7 @@ def main():
     
     args = parser.parse_args()
     
+    store_message(args.session_id, args.query, "user")
     response = answer_query_with_conversation_context(
         session_id=args.session_id,
         query=args.query,
@@ -187,6 +219,8 @@ def main():
         top_k_conversations=args.top_k_conversations
     )
     
+    store_message(args.session_id, response["answer"], "assistant")
+    
     print("\nAnswer:")
     print(response["answer"])
     
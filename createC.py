@@ -1,31 +1,11 @@
-from qdrant_client.models import VectorParams, Distance
-from qdrant_client import QdrantClient
-from sentence_transformers import SentenceTransformer
-
-# Qdrant client setup
-qdrant_client = QdrantClient(url="http://localhost:6333")
-
-# Embedding model for chat memory
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+# Create the chat memory and document collections with the same settings the
+# app uses (vector layout, quantization, HNSW and payload indexes), so this
+# script can't drift from memory_manager and qdrant_helper.
+from memory_manager import ensure_memory_collection_exists
+from qdrant_helper import create_collection_if_not_exists
 
 # Collection names
 DOCUMENT_COLLECTION = "document_chunks"
-MEMORY_COLLECTION = "chat_memory"
-
-# Create a separate collection for chat memory
-qdrant_client.create_collection(
-    collection_name=MEMORY_COLLECTION,
-    vectors_config=VectorParams(
-        size=embedding_model.get_sentence_embedding_dimension(),
-        distance=Distance.COSINE
-    )
-)
 
-# Create a separate collection for document collection
-qdrant_client.create_collection(
-    collection_name=DOCUMENT_COLLECTION,
-    vectors_config=VectorParams(
-        size=embedding_model.get_sentence_embedding_dimension(),
-        distance=Distance.COSINE
-    )
-)
+ensure_memory_collection_exists()
+create_collection_if_not_exists(DOCUMENT_COLLECTION)
@@ -0,0 +1,105 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Constants
+USER_DB_FILE = "users.db"
+LEGACY_JSON_DB_FILE = "user_database.json"
+
+# A single connection is shared by all Streamlit script threads; the lock keeps
+# statements and their transactions from interleaving.
+conn = sqlite3.connect(USER_DB_FILE, check_same_thread=False)
+conn.row_factory = sqlite3.Row
+_lock = threading.Lock()
+
+
+def init_schema():
+    """Create the user, session and document tables if they don't exist."""
+    with _lock:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                email TEXT NOT NULL UNIQUE,
+                created_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS user_documents (
+                username TEXT NOT NULL,
+                doc TEXT NOT NULL,
+                PRIMARY KEY (username, doc)
+            );
+        """)
+        conn.commit()
+
+
+def migrate_legacy_json_db(path=LEGACY_JSON_DB_FILE):
+    """Import users and documents from the old JSON user database once.
+
+    Sessions are not carried over: they are now stored by hash, and the old
+    raw ids expire within a day anyway.
+    """
+    if not os.path.exists(path):
+        return
+    if fetch_one("SELECT 1 FROM users LIMIT 1"):
+        return
+
+    with open(path, "r") as f:
+        legacy_db = json.load(f)
+
+    with _lock, conn:
+        for username, user in legacy_db.get("users", {}).items():
+            conn.execute(
+                "INSERT OR IGNORE INTO users (username, password, email, created_at) VALUES (?, ?, ?, ?)",
+                (username, user["password"], user.get("email", ""), user.get("created_at", ""))
+            )
+            for doc in user.get("documents", []):
+                conn.execute(
+                    "INSERT OR IGNORE INTO user_documents (username, doc) VALUES (?, ?)",
+                    (username, doc)
+                )
+    logger.info(f"Migrated {len(legacy_db.get('users', {}))} users from {path}")
+
+
+def execute(sql, params=()):
+    """Run a write statement and commit it before returning.
+
+    Signups, logins and logouts are acknowledged to the user, so they must not
+    be lost to a crash; with WAL and synchronous=NORMAL a commit is cheap.
+    """
+    with _lock, conn:
+        return conn.execute(sql, params)
+
+
+def execute_many(sql, rows):
+    """Run a write statement once per row in a single committed transaction."""
+    with _lock, conn:
+        return conn.executemany(sql, rows)
+
+
+def fetch_one(sql, params=()):
+    """Run a query and return the first row, or None."""
+    with _lock:
+        return conn.execute(sql, params).fetchone()
+
+
+def fetch_all(sql, params=()):
+    """Run a query and return all rows."""
+    with _lock:
+        return conn.execute(sql, params).fetchall()
+
+
+init_schema()
+migrate_legacy_json_db()
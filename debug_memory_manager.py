@@ -1,5 +1,5 @@
 import logging
-from memory_manager import store_message, get_all_session_messages, retrieve_context_relevant_messages, format_context_messages
+from memory_manager import store_messages_batch, get_all_session_messages, retrieve_context_relevant_messages, format_context_messages
 from rag import process_document, answer_query_enhanced
 import os
 
@@ -22,8 +22,7 @@ def main():
     
     # Store messages
     logger.info("Storing messages in memory")
-    for content, role in messages:
-        store_message(session_id, content, role)
+    store_messages_batch(session_id, messages)
     
     # Retrieve all messages
     logger.info("Retrieving all stored messages")
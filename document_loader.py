@@ -1,9 +1,34 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
 import os
-from typing import List, Dict, Any, Tuple
-import uuid
+import re
+from typing import List, Dict
 import logging
-from fuzzywuzzy import fuzz, process
+from concurrent.futures import ThreadPoolExecutor
+
+# Chunk sizes for the default chunking strategies
+DEFAULT_CHUNK_SIZES = {"small": 500, "medium": 1000, "large": 2000}
+DEFAULT_OVERLAP_RATIO = 0.15
+
+# Default single-pass strategy: chunk boundaries follow topic shifts between
+# sentences, so far fewer chunks are embedded than with the three size-based passes
+SEMANTIC_STRATEGY = {"id": "semantic", "method": "semantic", "chunk_size": 1000, "similarity_threshold": 0.75}
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+def build_chunk_strategies(overlap_ratio: float = DEFAULT_OVERLAP_RATIO) -> List[Dict[str, int]]:
+    """
+    Build the default chunking strategies with an overlap proportional to chunk size.
+    
+    Args:
+        overlap_ratio: Fraction of each chunk that overlaps with the previous one
+            
+    Returns:
+        List of dictionaries containing id, chunk_size and chunk_overlap
+    """
+    return [
+        {"id": strategy_id, "chunk_size": chunk_size, "chunk_overlap": int(chunk_size * overlap_ratio)}
+        for strategy_id, chunk_size in DEFAULT_CHUNK_SIZES.items()
+    ]
 
 def load_and_chunk_documents_with_multiple_strategies(
     file_path: str, 
@@ -14,7 +39,8 @@ def load_and_chunk_documents_with_multiple_strategies(
     
     Args:
         file_path: Path to the document
-        chunk_strategies: List of dictionaries containing chunk_size and chunk_overlap
+        chunk_strategies: List of dictionaries containing chunk_size and chunk_overlap,
+            or "method": "semantic" entries (defaults to SEMANTIC_STRATEGY alone)
             
     Returns:
         Dictionary with strategy_id as key and list of chunks as value
@@ -24,11 +50,7 @@ def load_and_chunk_documents_with_multiple_strategies(
     
     # Default strategies if none provided
     if not chunk_strategies:
-        chunk_strategies = [
-            {"id": "small", "chunk_size": 500, "chunk_overlap": 50},
-            {"id": "medium", "chunk_size": 1000, "chunk_overlap": 100},
-            {"id": "large", "chunk_size": 2000, "chunk_overlap": 200},
-        ]
+        chunk_strategies = [SEMANTIC_STRATEGY]
     
     # Determine loader based on file extension
     if file_path.endswith('.pdf'):
@@ -39,7 +61,6 @@ def load_and_chunk_documents_with_multiple_strategies(
         loader = Docx2txtLoader(file_path)
     elif file_path.endswith('.md'):
         from langchain_community.document_loaders import UnstructuredMarkdownLoader
-        from langchain_core.documents import Document
 
         # markdown_path = "../../../README.md"
         loader = UnstructuredMarkdownLoader(file_path)
@@ -55,24 +76,113 @@ def load_and_chunk_documents_with_multiple_strategies(
     # Load the document
     documents = loader.load()
     
-    # Apply each chunking strategy
+    # Apply each chunking strategy; they are independent passes over the same
+    # loaded documents, so they run concurrently
+    with ThreadPoolExecutor(max_workers=len(chunk_strategies)) as executor:
+        futures = {
+            strategy["id"]: executor.submit(chunk_with_strategy, documents, strategy)
+            for strategy in chunk_strategies
+        }
+    
     all_chunks = {}
-    for strategy in chunk_strategies:
-        strategy_id = strategy["id"]
-        chunk_size = strategy["chunk_size"]
-        chunk_overlap = strategy["chunk_overlap"]
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size, 
-            chunk_overlap=chunk_overlap
-        )
-        chunks = text_splitter.split_documents(documents)
+    for strategy_id, future in futures.items():
+        chunks = future.result()
         all_chunks[strategy_id] = chunks
         
         logging.info(f"Strategy '{strategy_id}' generated {len(chunks)} chunks")
     
     return all_chunks
 
+def chunk_with_strategy(documents, strategy: Dict) -> List:
+    """Chunk loaded documents with a single strategy definition."""
+    if strategy.get("method") == "semantic":
+        return create_semantic_chunks(
+            documents,
+            similarity_threshold=strategy.get("similarity_threshold", SEMANTIC_STRATEGY["similarity_threshold"]),
+            max_chunk_size=strategy["chunk_size"]
+        )
+    
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=strategy["chunk_size"], 
+        chunk_overlap=strategy["chunk_overlap"]
+    )
+    return text_splitter.split_documents(documents)
+
+def create_semantic_chunks(
+    documents, 
+    similarity_threshold: float = 0.75, 
+    max_chunk_size: int = 1000
+) -> List:
+    """
+    Create chunks whose boundaries fall where consecutive sentences change topic.
+    
+    Sentences are embedded with the shared embedding model; a new chunk starts when
+    the similarity to the previous sentence drops below the threshold or the chunk
+    would exceed max_chunk_size. Sentences longer than max_chunk_size (or text with
+    no sentence punctuation) are split by size first, so no chunk exceeds it.
+    Documents with no topical break at all fall back to rolling windows with a
+    75% stride.
+    
+    Args:
+        documents: Loaded documents
+        similarity_threshold: Cosine similarity below which a new chunk starts
+        max_chunk_size: Maximum chunk length in characters
+        
+    Returns:
+        List of chunks
+    """
+    from embeddings import embeddings_model
+    
+    semantic_chunks = []
+    oversize_splitter = RecursiveCharacterTextSplitter(chunk_size=max_chunk_size, chunk_overlap=0)
+    
+    for doc in documents:
+        sentences = [
+            piece
+            for sentence in SENTENCE_BOUNDARY.split(doc.page_content) if sentence.strip()
+            for piece in (oversize_splitter.split_text(sentence) if len(sentence) > max_chunk_size else [sentence])
+        ]
+        if len(sentences) < 2:
+            if sentences:
+                semantic_chunks.append(Document(
+                    page_content=sentences[0],
+                    metadata={**doc.metadata, "chunk_type": "semantic"}
+                ))
+            continue
+        
+        embeddings = embeddings_model.encode(
+            sentences, batch_size=64, convert_to_numpy=True, normalize_embeddings=True
+        )
+        similarities = (embeddings[:-1] * embeddings[1:]).sum(axis=1)
+        
+        if (similarities >= similarity_threshold).all():
+            semantic_chunks.extend(create_rolling_window_chunks(
+                [doc], window_size=max_chunk_size, step_size=int(max_chunk_size * 0.75)
+            ))
+            continue
+        
+        current = [sentences[0]]
+        current_size = len(sentences[0])
+        for sentence, similarity in zip(sentences[1:], similarities):
+            if similarity < similarity_threshold or current_size + 1 + len(sentence) > max_chunk_size:
+                semantic_chunks.append(Document(
+                    page_content=" ".join(current),
+                    metadata={**doc.metadata, "chunk_type": "semantic"}
+                ))
+                current = [sentence]
+                current_size = len(sentence)
+            else:
+                current.append(sentence)
+                current_size += 1 + len(sentence)
+        
+        semantic_chunks.append(Document(
+            page_content=" ".join(current),
+            metadata={**doc.metadata, "chunk_type": "semantic"}
+        ))
+    
+    logging.info(f"Semantic chunking generated {len(semantic_chunks)} chunks")
+    return semantic_chunks
+
 def create_rolling_window_chunks(
     documents, 
     window_size: int = 1000, 
@@ -100,21 +210,26 @@ def create_rolling_window_chunks(
             rolling_chunks.append(doc)
             continue
         
-        # Create rolling window chunks
-        for i in range(0, len(text) - window_size + 1, step_size):
-            chunk_text = text[i:i + window_size]
-            
-            # Create new metadata with position info
-            chunk_metadata = metadata.copy()
-            chunk_metadata.update({
-                "chunk_start": i,
-                "chunk_end": i + window_size,
-                "chunk_type": "rolling_window"
-            })
-            
-            from langchain.schema import Document
-            chunk = Document(page_content=chunk_text, metadata=chunk_metadata)
-            rolling_chunks.append(chunk)
+        # The last window is aligned to the end of the text so the tail that the
+        # stride would skip is still covered
+        starts = list(range(0, len(text) - window_size + 1, step_size))
+        if starts[-1] + window_size < len(text):
+            starts.append(len(text) - window_size)
+        
+        # Create rolling window chunks; str slicing is already a C-level copy, so
+        # the windows are built in one comprehension with position metadata merged in
+        rolling_chunks.extend(
+            Document(
+                page_content=text[i:i + window_size],
+                metadata={
+                    **metadata,
+                    "chunk_start": i,
+                    "chunk_end": i + window_size,
+                    "chunk_type": "rolling_window"
+                }
+            )
+            for i in starts
+        )
     
     logging.info(f"Rolling window approach generated {len(rolling_chunks)} chunks")
     return rolling_chunks
\ No newline at end of file
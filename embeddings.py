@@ -1,13 +1,48 @@
 from sentence_transformers import SentenceTransformer
+import os
 import torch
+import numpy as np
 
+# The one shared embedding model; memory_manager, qdrant_helper and rag all
+# import it from here so the weights and tokenizer are loaded once
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-embeddings_model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+
+# On CPU, EMBEDDINGS_BACKEND=onnx runs the model's published INT8 ONNX export
+# through ONNX Runtime (needs sentence-transformers>=3.2 and optimum[onnxruntime])
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "torch")
+ONNX_MODEL_FILE = os.getenv("EMBEDDINGS_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+
+if device == 'cpu' and EMBEDDINGS_BACKEND == 'onnx':
+    embeddings_model = SentenceTransformer(
+        'all-MiniLM-L6-v2',
+        device=device,
+        backend='onnx',
+        model_kwargs={"file_name": ONNX_MODEL_FILE}
+    )
+else:
+    embeddings_model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+embeddings_model.max_seq_length = 256
+# fp16 halves memory traffic on GPU; the cosine ranking is unaffected in practice
+if device == 'cuda':
+    embeddings_model = embeddings_model.half()
+
+# A few dummy batches at import move the one-time costs (CUDA context, kernel
+# selection, ONNX session setup) out of the first user query
+if os.getenv("WARMUP_MODELS", "1") == "1":
+    for _ in range(3):
+        embeddings_model.encode(["warmup"] * 4, show_progress_bar=False)
 
 def generate_embeddings(chunks):
     texts = [chunk.page_content for chunk in chunks]
-    embeddings = embeddings_model.encode(texts)
-    return embeddings
+    embeddings = embeddings_model.encode(
+        texts,
+        batch_size=128,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False
+    )
+    # Qdrant expects float32 vectors
+    return embeddings.astype(np.float32, copy=False)
 
 # Example usage
 if __name__ == '__main__':
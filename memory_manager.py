@@ -1,10 +1,29 @@
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, Filter, FieldCondition, MatchValue, Range
-from sentence_transformers import SentenceTransformer
+from qdrant_client.models import (
+    PointStruct,
+    Filter,
+    FieldCondition,
+    MatchValue,
+    Range,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    SearchParams,
+    QuantizationSearchParams,
+    OrderBy,
+    Direction,
+    PayloadSchemaType,
+    HnswConfigDiff,
+)
 import uuid
+import time
 import logging
+import threading
 from typing import List
+from embeddings import embeddings_model as embedding_model
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -12,15 +31,32 @@ logger = logging.getLogger(__name__)
 
 # Constants
 COLLECTION_NAME = "chat_memory"
-EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 
-# Initialize Qdrant and Embedding Model
-qdrant_client = QdrantClient(url="http://localhost:6333")
-embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+# Message class for each stored role
+MESSAGE_CLASSES = {"user": HumanMessage, "assistant": AIMessage, "system": SystemMessage}
+
+# Quantization used when the chat memory collection is created: "int8" suits
+# ordinary chat histories; "binary" (1 bit per dimension) is for very large
+# collections, at some recall cost on small 384-dim vectors. Binary candidates
+# are noisier, so searches oversample more before rescoring.
+MEMORY_QUANTIZATION = "int8"
+QUANTIZATION_OVERSAMPLING = {"int8": 2.0, "binary": 4.0}
+
+# Initialize Qdrant; points go over gRPC (protobuf) rather than JSON over HTTP
+qdrant_client = QdrantClient(url="http://localhost:6333", prefer_grpc=True, grpc_port=6334)
+
+# Last sequence number handed out per session; seeded from Qdrant on first use
+_session_seq = {}
+_session_seq_lock = threading.Lock()
+_memory_collection_ready = False
 
 
 def ensure_memory_collection_exists():
-    """Ensure the chat memory collection exists in Qdrant."""
+    """Ensure the chat memory collection and its payload indexes exist in Qdrant."""
+    global _memory_collection_ready
+    if _memory_collection_ready:
+        return
+
     collections = qdrant_client.get_collections()
     collection_names = [collection.name for collection in collections.collections]
 
@@ -31,32 +67,54 @@ def ensure_memory_collection_exists():
             collection_name=COLLECTION_NAME,
             vectors_config=VectorParams(
                 size=embedding_model.get_sentence_embedding_dimension(),
-                distance=Distance.COSINE
+                # Vectors are L2-normalized on encode, so dot product equals cosine
+                distance=Distance.DOT,
+                on_disk=True
             ),
+            # Quantized copy in RAM, fp32 originals on disk
+            quantization_config=memory_quantization_config(),
+            hnsw_config=HnswConfigDiff(m=16, ef_construct=128),
         )
 
+    # Every search, scroll and count filters on session_id; scrolling ordered by
+    # sequence_num also requires an index on it
+    qdrant_client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="session_id",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+    qdrant_client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="sequence_num",
+        field_schema=PayloadSchemaType.INTEGER
+    )
+    _memory_collection_ready = True
+
+
+def memory_quantization_config():
+    """Build the Qdrant quantization config selected by MEMORY_QUANTIZATION."""
+    if MEMORY_QUANTIZATION == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    return ScalarQuantization(
+        scalar=ScalarQuantizationConfig(
+            type=ScalarType.INT8,
+            quantile=0.99,
+            always_ram=True
+        )
+    )
+
 
 def store_message(session_id: str, message_content: str, role: str, timestamp=None, message_id=None):
     """Store a chat message in Qdrant with metadata."""
     ensure_memory_collection_exists()
 
     # Generate embedding
-    embedding = embedding_model.encode(message_content).tolist()
+    embedding = embedding_model.encode(message_content, normalize_embeddings=True).tolist()
 
     # Generate message ID if not provided
     message_id = message_id or str(uuid.uuid4())
 
-    # Get sequence number (number of messages in this session + 1)
-    filter_query = Filter(must=[
-        FieldCondition(key="session_id", match=MatchValue(value=session_id))
-    ])
-
-    existing_messages = qdrant_client.scroll(
-    collection_name=COLLECTION_NAME,
-    scroll_filter=filter_query,
-    limit=1000
-    )[0]
-    sequence_num = len(existing_messages) + 1
+    sequence_num = next_sequence_num(session_id)
 
     # Store the message
     point = PointStruct(
@@ -67,7 +125,7 @@ def store_message(session_id: str, message_content: str, role: str, timestamp=No
             "content": message_content,
             "role": role,
             "sequence_num": sequence_num,
-            "timestamp": timestamp or import_time_module().time()
+            "timestamp": timestamp or time.time()
         }
     )
 
@@ -75,10 +133,62 @@ def store_message(session_id: str, message_content: str, role: str, timestamp=No
     logger.info(f"Stored message (role={role}, seq={sequence_num}) in session {session_id}")
 
 
-def import_time_module():
-    """Helper function to import time module."""
-    import time
-    return time
+def store_messages_batch(session_id: str, items: List, timestamp=None, wait: bool = True):
+    """Store several (content, role) messages with one encode pass and one upsert.
+
+    With wait=False the upsert returns once Qdrant has accepted the points,
+    without waiting for them to be indexed.
+    """
+    if not items:
+        return
+
+    ensure_memory_collection_exists()
+
+    contents = [content for content, _ in items]
+    embeddings = embedding_model.encode(contents, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+
+    first_seq = next_sequence_num(session_id, count=len(items))
+    timestamp = timestamp or time.time()
+
+    points = [
+        PointStruct(
+            id=str(uuid.uuid4()),
+            vector=embedding.tolist(),
+            payload={
+                "session_id": session_id,
+                "content": content,
+                "role": role,
+                "sequence_num": first_seq + i,
+                "timestamp": timestamp
+            }
+        )
+        for i, ((content, role), embedding) in enumerate(zip(items, embeddings))
+    ]
+
+    qdrant_client.upsert(COLLECTION_NAME, points, wait=wait)
+    logger.info(f"Stored {len(points)} messages (seq={first_seq}-{first_seq + len(points) - 1}) in session {session_id}")
+
+
+def next_sequence_num(session_id: str, count: int = 1) -> int:
+    """Reserve `count` sequence numbers for a session and return the first one.
+
+    Only the first call per session asks Qdrant how many messages exist; after
+    that the counter is kept in memory.
+    """
+    with _session_seq_lock:
+        if session_id not in _session_seq:
+            filter_query = Filter(must=[
+                FieldCondition(key="session_id", match=MatchValue(value=session_id))
+            ])
+            _session_seq[session_id] = qdrant_client.count(
+                collection_name=COLLECTION_NAME,
+                count_filter=filter_query,
+                exact=True
+            ).count
+
+        first_seq = _session_seq[session_id] + 1
+        _session_seq[session_id] += count
+        return first_seq
 
 
 def retrieve_messages_by_sequence(session_id: str, start_seq: int = None, end_seq: int = None) -> List:
@@ -94,44 +204,36 @@ def retrieve_messages_by_sequence(session_id: str, start_seq: int = None, end_se
 
         filter_query.append(FieldCondition(key="sequence_num", range=Range(**range_condition)))
 
-    # Execute query
+    ensure_memory_collection_exists()
+
+    # Qdrant returns the range already ordered by sequence number
+    limit = end_seq - start_seq + 1 if start_seq is not None and end_seq is not None else 1000
     search_result = qdrant_client.scroll(
     collection_name=COLLECTION_NAME,
     scroll_filter=Filter(must=filter_query), 
-    limit=1000,
+    limit=limit,
     with_payload=True,
+    order_by=OrderBy(key="sequence_num", direction=Direction.ASC),
     )[0]
 
-    # Create a mapping of content to sequence number for easier lookup
-    content_to_seq = {}
-    for result in search_result:
-        if "sequence_num" in result.payload:
-            content_to_seq[result.payload["content"]] = result.payload["sequence_num"]
-
+    # Each message carries its sequence number so callers can tell messages apart
+    # without comparing their content
     messages = []
     for result in search_result:
         payload = result.payload
-        if payload["role"] == "user":
-            messages.append(HumanMessage(content=payload["content"]))
-        elif payload["role"] == "assistant":
-            messages.append(AIMessage(content=payload["content"]))
-        elif payload["role"] == "system":
-            messages.append(SystemMessage(content=payload["content"]))
-
-    # Sort by sequence number if available, otherwise leave in order returned by DB
-    if content_to_seq:
-        try:
-            messages.sort(key=lambda x: content_to_seq.get(x.content, 0))
-        except Exception as e:
-            logger.warning(f"Error sorting messages: {e}")
-            # Fall back to not sorting if there's an error
+        message_class = MESSAGE_CLASSES.get(payload["role"])
+        if message_class is not None:
+            messages.append(message_class(
+                content=payload["content"],
+                additional_kwargs={"sequence_num": payload.get("sequence_num")}
+            ))
 
     return messages
 
 
 def retrieve_context_relevant_messages(session_id: str, query: str, context_window: int = 2, top_k: int = 5) -> List:
     """Retrieve relevant messages based on semantic similarity with context."""
-    query_vector = embedding_model.encode(query).tolist()
+    query_vector = embedding_model.encode(query, normalize_embeddings=True).tolist()
 
     filter_query = Filter(must=[
         FieldCondition(key="session_id", match=MatchValue(value=session_id))
@@ -142,7 +244,14 @@ def retrieve_context_relevant_messages(session_id: str, query: str, context_wind
         query_vector=query_vector,
         query_filter=filter_query,
         limit=top_k,
-        score_threshold=0.6
+        score_threshold=0.6,
+        # Search the quantized vectors, oversample, then rescore the candidates in fp32
+        search_params=SearchParams(
+            quantization=QuantizationSearchParams(
+                rescore=True,
+                oversampling=QUANTIZATION_OVERSAMPLING[MEMORY_QUANTIZATION]
+            )
+        )
     )
 
     if not search_results:
@@ -184,12 +293,13 @@ def retrieve_context_relevant_messages(session_id: str, query: str, context_wind
         messages = retrieve_messages_by_sequence(session_id, start_seq, end_seq)
         all_messages.extend(messages)
 
-    # Remove duplicates
+    # Remove duplicates by sequence number
     seen = set()
     unique_messages = []
     for msg in all_messages:
-        if msg.content not in seen:
-            seen.add(msg.content)
+        sequence_num = msg.additional_kwargs.get("sequence_num")
+        if sequence_num not in seen:
+            seen.add(sequence_num)
             unique_messages.append(msg)
 
     logger.info(f"Retrieved {len(unique_messages)} relevant messages from {len(merged_ranges)} segments")
@@ -233,8 +343,7 @@ def main():
     ]
 
     # Store messages
-    for content, role in messages:
-        store_message(session_id, content, role)
+    store_messages_batch(session_id, messages)
 
     # Retrieve all messages
     all_messages = get_all_session_messages(session_id)
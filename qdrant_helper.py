@@ -1,25 +1,79 @@
+import os
 import uuid
+import heapq
+import queue
 import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Any, Tuple
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import VectorParams, Distance
-from sentence_transformers import SentenceTransformer
-from qdrant_client.models import PointStruct, Filter, FieldCondition, MatchValue
-from fuzzywuzzy import fuzz, process
+from qdrant_client.http.models import (
+    VectorParams, Distance, HnswConfigDiff, SearchParams, QuantizationSearchParams,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType
+)
+from embeddings import embeddings_model as model
+from qdrant_client.models import (
+    Batch, Filter, FieldCondition, MatchValue, MatchText,
+    TextIndexParams, TokenizerType
+)
+from rapidfuzz import fuzz, process, utils
 
-# Initialize Qdrant client and model
-qdrant_client = QdrantClient(host="localhost", port=6333)
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# Initialize Qdrant client; points go over gRPC (protobuf) rather than JSON over
+# HTTP, with room for full upload batches in one message
+qdrant_client = QdrantClient(
+    host="localhost",
+    port=6333,
+    grpc_port=6334,
+    prefer_grpc=True,
+    timeout=60,
+    grpc_options={"grpc.max_send_message_length": 64 * 1024 * 1024}
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
 COLLECTION_NAME = "document_chunks"
+# Texts per encoder forward pass when indexing; tune for the available RAM/VRAM
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Shortest word kept by the full-text index on chunk text
+TEXT_INDEX_MIN_TOKEN_LEN = 2
+# Upper bound on candidates fuzzy search pulls from the full-text index (the
+# old unfiltered scan read 1000), fetched in pages of FUZZY_SCROLL_PAGE_SIZE
+FUZZY_MAX_CANDIDATES = 2000
+FUZZY_SCROLL_PAGE_SIZE = 256
+# Words too common to narrow the candidate set; they are still scored by RapidFuzz
+FUZZY_STOPWORDS = frozenset("""
+a an and are as at be but by can did do does for from had has have he her his how i if in
+into is it its me my no not of on or our she so than that the their them then there these
+they this to was we were what when where which who whom why will with you your
+""".split())
+# HNSW beam width at query time; higher trades latency for recall
+SEARCH_HNSW_EF = 64
+# Searches run on the int8 vectors, then rescore this many times top_k
+# candidates against the full-precision ones
+QUANTIZATION_OVERSAMPLING = 2.0
+SEARCH_PARAMS = SearchParams(
+    hnsw_ef=SEARCH_HNSW_EF,
+    exact=False,
+    quantization=QuantizationSearchParams(
+        ignore=False,
+        rescore=True,
+        oversampling=QUANTIZATION_OVERSAMPLING
+    )
+)
+
+# Collections already checked or created by this process
+_known_collections = set()
 
 def create_collection_if_not_exists(collection_name):
     """
     Creates a Qdrant collection if it doesn't already exist.
+    The check runs once per collection per process.
     """
+    if collection_name in _known_collections:
+        return
+    
     try:
         collections_response = qdrant_client.get_collections()
         existing_collections = [col.name for col in collections_response.collections]
@@ -30,15 +84,64 @@ def create_collection_if_not_exists(collection_name):
                 vectors_config=VectorParams(
                     size=384,  # Embedding dimension of all-MiniLM-L6-v2
                     distance=Distance.COSINE  # Cosine distance for similarity search
+                ),
+                hnsw_config=HnswConfigDiff(m=16, ef_construct=128, full_scan_threshold=10000),
+                quantization_config=ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(
+                        type=ScalarType.INT8,
+                        quantile=0.99,
+                        always_ram=True
+                    )
                 )
             )
             logging.info(f"Collection '{collection_name}' created.")
         else:
             logging.info(f"Collection '{collection_name}' already exists.")
+
+        # Full-text index so fuzzy search can preselect candidates in Qdrant
+        qdrant_client.create_payload_index(
+            collection_name=collection_name,
+            field_name="text",
+            field_schema=TextIndexParams(
+                type="text",
+                tokenizer=TokenizerType.WORD,
+                lowercase=True,
+                min_token_len=TEXT_INDEX_MIN_TOKEN_LEN
+            )
+        )
+        _known_collections.add(collection_name)
     except Exception as e:
         logging.error(f"Error creating collection '{collection_name}': {e}")
         raise
 
+def _upsert_worker(collection_name: str, upload_queue: queue.Queue) -> None:
+    """
+    Upsert point batches from the queue until the None sentinel arrives.
+    After a failure the rest of the queue is drained so the producer never
+    blocks, and the error is raised once the sentinel is reached.
+    """
+    error = None
+    while True:
+        item = upload_queue.get()
+        if item is None:
+            break
+        if error is None:
+            points, wait = item
+            try:
+                qdrant_client.upsert(collection_name=collection_name, points=points, wait=wait)
+            except Exception as e:
+                error = e
+    if error is not None:
+        raise error
+
+@lru_cache(maxsize=1024)
+def encode_query(query_text: str) -> Tuple[float, ...]:
+    """
+    Embed a query once; repeated queries (hybrid search, strategy comparison,
+    reruns) reuse the cached vector instead of running the encoder again.
+    """
+    return tuple(model.encode([query_text], convert_to_numpy=True, normalize_embeddings=True)[0].tolist())
+
 def index_document_with_strategies(
     collection_name: str, 
     document_id: str, 
@@ -66,85 +169,69 @@ def index_document_with_strategies(
         results = {}
         total_chunks = 0
         
-        # Process each chunking strategy
+        # Gather the chunks of every strategy, rolling windows included
+        strategy_chunks = {}
         for strategy_id, chunks in chunking_strategies.items():
             if not chunks:
                 logging.warning(f"No chunks provided for strategy '{strategy_id}'")
                 results[strategy_id] = {"status": "error", "message": "No chunks found"}
                 continue
-            
-            logging.info(f"Indexing {len(chunks)} chunks for strategy '{strategy_id}'")
-            
-            for i in range(0, len(chunks), batch_size):
-                batch = chunks[i:i + batch_size]
-                logging.info(f"Processing batch {i//batch_size + 1}, size: {len(batch)}")
-                
-                # Get embeddings only for text content in chunks
-                embeddings = model.encode([chunk.page_content for chunk in batch], convert_to_tensor=False).tolist()
-                
-                points = []
-                for idx, (chunk, embedding) in enumerate(zip(batch, embeddings)):
-                    chunk_id = str(uuid.uuid4())
-                    payload = {
-                        "document_id": document_id,
-                        "text": chunk.page_content,
-                        "metadata": chunk.metadata,
-                        "chunk_index": i + idx,
-                        "strategy": strategy_id
-                    }
-                    points.append(
-                        PointStruct(
-                            id=chunk_id,
-                            vector=embedding,
-                            payload=payload
-                        )
-                    )
-                
-                qdrant_client.upsert(
-                    collection_name=collection_name,
-                    points=points,
-                    wait=True
-                )
-            
-            results[strategy_id] = {"status": "success", "chunks": len(chunks)}
-            total_chunks += len(chunks)
+            strategy_chunks[strategy_id] = chunks
         
-        # Process rolling window chunks if provided
         if rolling_window_chunks:
-            logging.info(f"Indexing {len(rolling_window_chunks)} rolling window chunks")
-            
-            for i in range(0, len(rolling_window_chunks), batch_size):
-                batch = rolling_window_chunks[i:i + batch_size]
-                
-                # Get embeddings only for text content in chunks
-                embeddings = model.encode([chunk.page_content for chunk in batch], convert_to_tensor=False).tolist()
-                
-                points = []
-                for idx, (chunk, embedding) in enumerate(zip(batch, embeddings)):
-                    chunk_id = str(uuid.uuid4())
-                    payload = {
-                        "document_id": document_id,
-                        "text": chunk.page_content,
-                        "metadata": chunk.metadata,
-                        "chunk_index": i + idx,
-                        "strategy": "rolling_window"
-                    }
-                    points.append(
-                        PointStruct(
-                            id=chunk_id,
-                            vector=embedding,
-                            payload=payload
+            strategy_chunks["rolling_window"] = rolling_window_chunks
+        
+        # Only the last upsert has to wait: Qdrant applies updates to a
+        # collection in order, so once it is acknowledged all earlier ones are too
+        batch_count = sum((len(chunks) + batch_size - 1) // batch_size for chunks in strategy_chunks.values())
+        batches_sent = 0
+        
+        # The encoder runs here while a single worker upserts the previous
+        # batches, so neither the model nor the network sits idle
+        upload_queue = queue.Queue(maxsize=4)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            upload = executor.submit(_upsert_worker, collection_name, upload_queue)
+            try:
+                for strategy_id, chunks in strategy_chunks.items():
+                    logging.info(f"Indexing {len(chunks)} chunks for strategy '{strategy_id}'")
+                    
+                    for i in range(0, len(chunks), batch_size):
+                        batch = chunks[i:i + batch_size]
+                        logging.info(f"Processing batch {i//batch_size + 1}, size: {len(batch)}")
+                        
+                        embeddings = model.encode(
+                            [chunk.page_content for chunk in batch],
+                            batch_size=EMBED_BATCH_SIZE,
+                            convert_to_numpy=True,
+                            normalize_embeddings=True,
+                            show_progress_bar=False
                         )
-                    )
-                
-                qdrant_client.upsert(
-                    collection_name=collection_name,
-                    points=points,
-                    wait=True
-                )
-            
-            results["rolling_window"] = {"status": "success", "chunks": len(rolling_window_chunks)}
-            total_chunks += len(rolling_window_chunks)
+                        
+                        # Columnar batch: the whole embedding matrix is converted in
+                        # one call and no per-point model objects are validated
+                        points = Batch(
+                            ids=[str(uuid.uuid4()) for _ in batch],
+                            vectors=embeddings.tolist(),
+                            payloads=[
+                                {
+                                    "document_id": document_id,
+                                    "text": chunk.page_content,
+                                    "metadata": chunk.metadata,
+                                    "chunk_index": i + idx,
+                                    "strategy": strategy_id
+                                }
+                                for idx, chunk in enumerate(batch)
+                            ]
+                        )
+                        
+                        batches_sent += 1
+                        upload_queue.put((points, batches_sent == batch_count))
+                    
+                    results[strategy_id] = {"status": "success", "chunks": len(chunks)}
+                    total_chunks += len(chunks)
+            finally:
+                upload_queue.put(None)
+            upload.result()
         
         logging.info(f"Total chunks indexed: {total_chunks}")
         
@@ -161,7 +248,8 @@ def query_qdrant_multi_strategy(
     collection_name: str, 
     query_text: str, 
     strategies: List[str] = None,
-    top_k: int = 5
+    top_k: int = 5,
+    query_vector: Tuple[float, ...] = None
 ) -> List[Dict]:
     """
     Query the Qdrant collection across multiple chunking strategies and return top results.
@@ -171,12 +259,13 @@ def query_qdrant_multi_strategy(
         query_text: Query text
         strategies: List of strategies to query (None = all strategies)
         top_k: Number of results to retrieve per strategy
+        query_vector: Precomputed embedding of query_text (encoded if omitted)
         
     Returns:
         Combined and sorted list of results
     """
     try:
-        query_vector = model.encode([query_text], convert_to_tensor=False)[0].tolist()
+        query_vector = list(query_vector or encode_query(query_text))
         all_results = []
         
         # If no specific strategies provided, query all strategies
@@ -185,11 +274,12 @@ def query_qdrant_multi_strategy(
                 collection_name=collection_name,
                 query_vector=query_vector,
                 limit=top_k * 3,  # Get more results to account for multiple strategies
-                score_threshold=0.3
+                search_params=SEARCH_PARAMS
             )
             
             for hit in search_results:
                 all_results.append({
+                    "id": hit.id,
                     "score": hit.score,
                     "text": hit.payload['text'],
                     "metadata": hit.payload.get("metadata", {}),
@@ -212,21 +302,21 @@ def query_qdrant_multi_strategy(
                     collection_name=collection_name,
                     query_vector=query_vector,
                     limit=top_k,
-                    score_threshold=0.3,
-                    filter=filter_by_strategy
+                    search_params=SEARCH_PARAMS,
+                    query_filter=filter_by_strategy
                 )
                 
                 for hit in strategy_results:
                     all_results.append({
+                        "id": hit.id,
                         "score": hit.score,
                         "text": hit.payload['text'],
                         "metadata": hit.payload.get("metadata", {}),
                         "strategy": hit.payload.get("strategy", strategy)
                     })
         
-        # Sort by score and take top results
-        all_results.sort(key=lambda x: x["score"], reverse=True)
-        top_results = all_results[:top_k]
+        # Take the top results without sorting every candidate
+        top_results = heapq.nlargest(top_k, all_results, key=lambda x: x["score"])
         
         logging.info(f"Multi-strategy query returned {len(top_results)} results from {len(all_results)} candidates")
         return top_results
@@ -237,7 +327,11 @@ def query_qdrant_multi_strategy(
 
 def fuzzy_search(collection_name: str, query_text: str, min_score: int = 70, top_k: int = 5) -> List[Dict]:
     """
-    Perform fuzzy text search on documents using fuzzywuzzy.
+    Perform fuzzy text search on documents using RapidFuzz.
+    
+    Candidates sharing at least one non-stopword with the query are selected
+    by the collection's full-text index; only those are transferred and
+    rescored.
     
     Args:
         collection_name: Qdrant collection name
@@ -249,42 +343,68 @@ def fuzzy_search(collection_name: str, query_text: str, min_score: int = 70, top
         List of matching results with scores
     """
     try:
-        # Get all documents from the collection
-        # In a production environment, this would need pagination for large collections
-        scroll_results = qdrant_client.scroll(
-            collection_name=collection_name,
-            limit=1000,  # Consider implementing proper pagination in production
-            with_payload=True
+        query_words = {
+            word for word in utils.default_process(query_text).split()
+            if len(word) >= TEXT_INDEX_MIN_TOKEN_LEN
+        }
+        # Stopwords would match nearly every chunk; only fall back to them when
+        # the query has nothing else
+        query_words = (query_words - FUZZY_STOPWORDS) or query_words
+        if not query_words:
+            return []
+        
+        # Any query word may match, so misspelt or extra words don't empty the set
+        text_filter = Filter(
+            should=[FieldCondition(key="text", match=MatchText(text=word)) for word in query_words]
         )
+        # Scroll order isn't relevance, so read every filtered match (up to the
+        # cap) rather than the first page before rescoring
+        all_documents = []
+        offset = None
+        while len(all_documents) < FUZZY_MAX_CANDIDATES:
+            page, offset = qdrant_client.scroll(
+                collection_name=collection_name,
+                scroll_filter=text_filter,
+                limit=min(FUZZY_SCROLL_PAGE_SIZE, FUZZY_MAX_CANDIDATES - len(all_documents)),
+                offset=offset,
+                with_payload=True,
+                with_vectors=False
+            )
+            all_documents.extend(page)
+            if offset is None:
+                break
         
-        all_documents = scroll_results[0]
         if not all_documents:
             return []
         
-        # Extract text content for fuzzy matching
-        documents_text = [(doc.id, doc.payload["text"]) for doc in all_documents if "text" in doc.payload]
+        # Keep the payload alongside the id so matches need no lookup afterwards
+        documents_text = [(doc.id, doc.payload) for doc in all_documents if "text" in doc.payload]
+        
+        # Score every text against the query in one batched call on all cores;
+        # default_process keeps fuzzywuzzy's normalization (lowercase, strip punctuation)
+        scores = process.cdist(
+            [query_text],
+            [payload["text"] for _, payload in documents_text],
+            scorer=fuzz.token_set_ratio,
+            processor=utils.default_process,
+            score_cutoff=min_score,
+            workers=-1
+        )[0]
         
-        # Perform fuzzy matching
         results = []
-        for doc_id, text in documents_text:
-            # Calculate similarity ratio
-            similarity = fuzz.token_set_ratio(query_text.lower(), text.lower())
-            
-            if similarity >= min_score:
-                # Find the original document to get the full data
-                doc = next((d for d in all_documents if d.id == doc_id), None)
-                if doc:
-                    results.append({
-                        "score": similarity / 100.0,  # Normalize to 0-1 scale to match vector search
-                        "text": doc.payload["text"],
-                        "metadata": doc.payload.get("metadata", {}),
-                        "strategy": doc.payload.get("strategy", "unknown"),
-                        "search_type": "fuzzy"
-                    })
+        for idx in np.nonzero(scores >= min_score)[0]:
+            doc_id, payload = documents_text[idx]
+            results.append({
+                "id": doc_id,
+                "score": float(scores[idx]) / 100.0,  # Normalize to 0-1 scale to match vector search
+                "text": payload["text"],
+                "metadata": payload.get("metadata", {}),
+                "strategy": payload.get("strategy", "unknown"),
+                "search_type": "fuzzy"
+            })
         
-        # Sort by score and take top results
-        results.sort(key=lambda x: x["score"], reverse=True)
-        top_results = results[:top_k]
+        # Take the top results without sorting every candidate
+        top_results = heapq.nlargest(top_k, results, key=lambda x: x["score"])
         
         logging.info(f"Fuzzy search returned {len(top_results)} results")
         return top_results
@@ -299,7 +419,8 @@ def hybrid_search(
     strategies: List[str] = None,
     vector_weight: float = 0.7, 
     fuzzy_weight: float = 0.3,
-    top_k: int = 5
+    top_k: int = 5,
+    query_vector: Tuple[float, ...] = None
 ) -> List[Dict]:
     """
     Perform hybrid search combining vector search and fuzzy text search.
@@ -311,6 +432,7 @@ def hybrid_search(
         vector_weight: Weight for vector search results (0-1)
         fuzzy_weight: Weight for fuzzy search results (0-1)
         top_k: Number of results to return
+        query_vector: Precomputed embedding of query_text (encoded if omitted)
         
     Returns:
         List of combined and ranked results
@@ -324,15 +446,16 @@ def hybrid_search(
             fuzzy_weight /= total
         
         # Get results from both search methods
-        vector_results = query_qdrant_multi_strategy(collection_name, query_text, strategies, top_k * 2)
+        vector_results = query_qdrant_multi_strategy(collection_name, query_text, strategies, top_k * 2, query_vector)
         fuzzy_results = fuzzy_search(collection_name, query_text, min_score=70, top_k=top_k * 2)
         
-        # Combine results and assign weighted scores
+        # Combine results by point id, so a chunk found by both searches gets
+        # both scores
         combined_results = {}
         
         # Process vector search results
         for result in vector_results:
-            doc_id = result.get("id", str(uuid.uuid4()))  # Use a unique ID if not available
+            doc_id = result["id"]
             combined_results[doc_id] = {
                 "vector_score": result["score"],
                 "fuzzy_score": 0,
@@ -343,7 +466,7 @@ def hybrid_search(
         
         # Process fuzzy search results
         for result in fuzzy_results:
-            doc_id = result.get("id", str(uuid.uuid4()))
+            doc_id = result["id"]
             if doc_id in combined_results:
                 # Document already in results, update fuzzy score
                 combined_results[doc_id]["fuzzy_score"] = result["score"]
@@ -371,9 +494,8 @@ def hybrid_search(
                 "strategy": result["strategy"]
             })
         
-        # Sort by combined score and take top results
-        results_list.sort(key=lambda x: x["score"], reverse=True)
-        top_results = results_list[:top_k]
+        # Take the top results by combined score without sorting every candidate
+        top_results = heapq.nlargest(top_k, results_list, key=lambda x: x["score"])
         
         logging.info(f"Hybrid search returned {len(top_results)} results")
         return top_results
@@ -1,9 +1,9 @@
 import os
 import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
 import qdrant_helper as qdrant_helper
 from document_loader import load_and_chunk_documents_with_multiple_strategies, create_rolling_window_chunks
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
@@ -23,8 +23,13 @@ if not DEEPSEEK_API_KEY:
 # Initialize OpenAI client with DeepSeek endpoint
 client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
 
-# Load Sentence Transformer for Query Embeddings
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+# Token budget for retrieved context sent to the LLM, estimated from character count
+CONTEXT_TOKEN_BUDGET = 3000
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    """Cheaply estimate the number of LLM tokens in a piece of text."""
+    return len(text) // CHARS_PER_TOKEN + 1
 
 def generate_answer(query, context, max_tokens=256, temperature=1.0):
     """
@@ -143,7 +148,7 @@ def process_document(file_path, document_id=None):
         logger.error(f"Error processing document: {str(e)}")
         return {"status": "error", "message": str(e)}
 
-def answer_query_enhanced(user_query, search_type="hybrid", top_k=5):
+def answer_query_enhanced(user_query, search_type="hybrid", top_k=5, query_vector=None):
     """
     Enhanced function to answer a user query using RAG with multiple strategies.
     
@@ -151,6 +156,7 @@ def answer_query_enhanced(user_query, search_type="hybrid", top_k=5):
         user_query (str): User's question
         search_type (str): Type of search - "vector", "fuzzy", or "hybrid"
         top_k (int): Maximum number of chunks to retrieve
+        query_vector: Precomputed query embedding shared across calls (optional)
         
     Returns:
         dict: Dictionary containing the answer and relevant chunks
@@ -163,7 +169,8 @@ def answer_query_enhanced(user_query, search_type="hybrid", top_k=5):
             context_items = qdrant_helper.query_qdrant_multi_strategy(
                 collection_name=qdrant_helper.COLLECTION_NAME,
                 query_text=user_query,
-                top_k=top_k
+                top_k=top_k,
+                query_vector=query_vector
             )
         elif search_type == "fuzzy":
             context_items = qdrant_helper.fuzzy_search(
@@ -177,7 +184,8 @@ def answer_query_enhanced(user_query, search_type="hybrid", top_k=5):
                 query_text=user_query,
                 vector_weight=0.7,
                 fuzzy_weight=0.3,
-                top_k=top_k
+                top_k=top_k,
+                query_vector=query_vector
             )
         
         logger.debug(f"Retrieved {len(context_items)} contexts using {search_type} search")
@@ -189,8 +197,19 @@ def answer_query_enhanced(user_query, search_type="hybrid", top_k=5):
                 "chunks": []
             }
 
-        # Extract text from the retrieved dictionaries
-        contexts = [item["text"] for item in context_items]
+        # Keep the highest-scoring unique chunks that fit in the context token budget
+        ranked_items = sorted(context_items, key=lambda x: x.get("score", 0), reverse=True)
+        seen = set()
+        contexts = []
+        running_tokens = 0
+        for item in ranked_items:
+            if item["text"] in seen:
+                continue
+            seen.add(item["text"])
+            running_tokens += estimate_tokens(item["text"])
+            if contexts and running_tokens > CONTEXT_TOKEN_BUDGET:
+                break
+            contexts.append(item["text"])
         
         # Combine text from all results
         combined_context = " ".join(contexts)
@@ -227,10 +246,19 @@ def compare_search_strategies(user_query, top_k=5):
     strategies = ["vector", "fuzzy", "hybrid"]
     results = {}
     
-    for strategy in strategies:
-        logger.info(f"Querying with {strategy} strategy")
-        result = answer_query_enhanced(user_query, search_type=strategy, top_k=top_k)
-        results[strategy] = result
+    # Encode the query once for every strategy that needs a vector
+    query_vector = qdrant_helper.encode_query(user_query)
+    
+    # Each strategy waits on Qdrant and the DeepSeek API, so run them side by side
+    with ThreadPoolExecutor(max_workers=len(strategies)) as executor:
+        futures = {}
+        for strategy in strategies:
+            logger.info(f"Querying with {strategy} strategy")
+            futures[strategy] = executor.submit(
+                answer_query_enhanced, user_query, search_type=strategy, top_k=top_k, query_vector=query_vector
+            )
+        for strategy, future in futures.items():
+            results[strategy] = future.result()
     
     # Determine best strategy based on context relevance
     # This is a simple heuristic - in production you might want more sophisticated metrics
@@ -1,9 +1,12 @@
 import streamlit as st
 import os
+import shutil
 import asyncio
 import bcrypt
 import uuid
 import json
+import threading
+import time
 from datetime import datetime, timedelta
 from memory_manager import store_message
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
@@ -24,26 +27,154 @@ from web_crawl import get_scrape_content
 
 # User authentication constants
 USER_DB_FILE = "user_database.json"
+SESSION_LOG_FILE = "sessions.jsonl"
+SESSION_LOG_MIN_COMPACT_LINES = 64
 SESSION_DURATION = timedelta(hours=24)
+SESSION_SWEEP_INTERVAL = 60  # seconds between expired-session sweeps
+BCRYPT_TARGET_SECONDS = 0.25
 
-# Initialize user database if it doesn't exist
+# Parsed user database, the file mtime it was read at, and a flat
+# username -> password hash index built from it. Held in st.cache_resource
+# because this script's globals are rebuilt on every rerun.
+@st.cache_resource
+def _db_cache():
+    return {"mtime": None, "data": None, "password_hashes": {}, "lock": threading.RLock()}
+
+def _set_cached_db(cache, db, mtime):
+    cache["data"] = db
+    cache["mtime"] = mtime
+    cache["password_hashes"] = {username: user["password"] for username, user in db["users"].items()}
+
+# Initialize user database if it doesn't exist; the file is only re-read
+# when something else has changed it since the last load or save
 def init_user_db():
-    if not os.path.exists(USER_DB_FILE):
+    cache = _db_cache()
+    with cache["lock"]:
+        if not os.path.exists(USER_DB_FILE):
+            save_user_db({"users": {}})
+            return cache["data"]
+        
+        mtime = os.stat(USER_DB_FILE).st_mtime_ns
+        if cache["data"] is None or mtime != cache["mtime"]:
+            with open(USER_DB_FILE, "r", encoding='utf-8') as f:
+                _set_cached_db(cache, json.load(f), mtime)
+        return cache["data"]
+
+# Save user database, writing through to the cache
+def save_user_db(db):
+    cache = _db_cache()
+    with cache["lock"]:
         with open(USER_DB_FILE, "w", encoding='utf-8') as f:
-            json.dump({"users": {}}, f, ensure_ascii=False)
-        return {"users": {}}
+            json.dump(db, f, ensure_ascii=False)
+        _set_cached_db(cache, db, os.stat(USER_DB_FILE).st_mtime_ns)
+
+# Stored password hash for a username, or None if there is no such user
+def get_password_hash(username):
+    init_user_db()
+    return _db_cache()["password_hashes"].get(username)
+
+# Session expiries are stored as epoch seconds; ISO strings written by older
+# versions are converted once when read
+def _expiry_timestamp(expires):
+    if isinstance(expires, str):
+        return datetime.fromisoformat(expires).timestamp()
+    return float(expires)
+
+# Live sessions as session_id -> (username, expiry as epoch seconds), replayed
+# from the append-only session log on first use. Logins and logouts append one
+# line instead of rewriting the user database, and validate_session only
+# compares floats.
+@st.cache_resource
+def _session_store():
+    store = {"sessions": {}, "lines": 0, "lock": threading.RLock()}
+    if os.path.exists(SESSION_LOG_FILE):
+        with open(SESSION_LOG_FILE, "r", encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # line torn by a crash mid-write
+                if event["op"] == "add":
+                    store["sessions"][event["sid"]] = (event["user"], _expiry_timestamp(event["exp"]))
+                else:
+                    store["sessions"].pop(event["sid"], None)
+                store["lines"] += 1
+    else:
+        # Carry over sessions saved in the user database by older versions
+        for sid, session in init_user_db().get("sessions", {}).items():
+            store["sessions"][sid] = (session["username"], _expiry_timestamp(session["expires"]))
+        _compact_session_log(store)
     
-    with open(USER_DB_FILE, "r", encoding='utf-8') as f:
-        return json.load(f)
+    threading.Thread(target=_sweep_sessions_forever, args=(store,), daemon=True).start()
+    return store
 
-# Save user database
-def save_user_db(db):
-    with open(USER_DB_FILE, "w", encoding='utf-8') as f:
-        json.dump(db, f, ensure_ascii=False)
+# Drop expired sessions in the background so the request path never writes
+def _sweep_sessions_forever(store):
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        now = time.time()
+        with store["lock"]:
+            expired = [sid for sid, (_, expires_at) in store["sessions"].items() if now > expires_at]
+            for sid in expired:
+                del store["sessions"][sid]
+            if expired:
+                _append_session_events(store, [{"op": "del", "sid": sid} for sid in expired])
+
+# Rewrite the log as one "add" line per live session
+def _compact_session_log(store):
+    tmp_file = SESSION_LOG_FILE + ".tmp"
+    with open(tmp_file, "w", encoding='utf-8') as f:
+        for sid, (username, expires_at) in store["sessions"].items():
+            f.write(json.dumps({"op": "add", "sid": sid, "user": username, "exp": expires_at}) + "\n")
+    os.replace(tmp_file, SESSION_LOG_FILE)
+    store["lines"] = len(store["sessions"])
+
+# Append session events in one write, compacting once dead lines outnumber
+# live sessions
+def _append_session_events(store, events):
+    with open(SESSION_LOG_FILE, "a", encoding='utf-8') as f:
+        f.write("".join(json.dumps(event) + "\n" for event in events))
+    store["lines"] += len(events)
+    if store["lines"] > max(2 * len(store["sessions"]), SESSION_LOG_MIN_COMPACT_LINES):
+        _compact_session_log(store)
+
+def add_session(session_id, username, expires_at):
+    store = _session_store()
+    with store["lock"]:
+        store["sessions"][session_id] = (username, expires_at)
+        _append_session_events(store, [{"op": "add", "sid": session_id, "user": username, "exp": expires_at}])
+
+def remove_session(session_id):
+    store = _session_store()
+    with store["lock"]:
+        if store["sessions"].pop(session_id, None) is None:
+            return False
+        _append_session_events(store, [{"op": "del", "sid": session_id}])
+        return True
+
+# Pick the highest bcrypt cost whose hash stays within the target time on this
+# host; the floor keeps slow hosts at a sane minimum. Cached so the calibration
+# runs once per process rather than on every script rerun.
+@st.cache_resource
+def calibrate_bcrypt_rounds(target_seconds=BCRYPT_TARGET_SECONDS, min_rounds=10, max_rounds=14):
+    rounds = min_rounds
+    for candidate in range(min_rounds, max_rounds + 1):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds=candidate))
+        if time.perf_counter() - start > target_seconds:
+            break
+        rounds = candidate
+    return rounds
+
+# Hash checked when the username is unknown, so a failed login takes as long
+# whether or not the account exists
+@st.cache_resource
+def _dummy_password_hash():
+    return bcrypt.hashpw(b"no-such-user", bcrypt.gensalt(rounds=calibrate_bcrypt_rounds()))
 
 # Hash password
 def hash_password(password):
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=calibrate_bcrypt_rounds())
     hashed = bcrypt.hashpw(password.encode(), salt)
     return hashed.decode()
 
@@ -62,6 +193,7 @@ def create_user(username, password, email):
         if user_data.get("email") == email:
             return False, "Email already registered"
     
+    # Hash only once the checks pass, so rejected sign-ups cost no bcrypt work
     hashed_password = hash_password(password)
     
     db["users"][username] = {
@@ -76,53 +208,37 @@ def create_user(username, password, email):
 
 # Authenticate user
 def authenticate_user(username, password):
-    db = init_user_db()
+    stored_hash = get_password_hash(username)
     
-    if username not in db["users"]:
+    if stored_hash is None:
+        bcrypt.checkpw(password.encode(), _dummy_password_hash())
         return False, "Invalid username or password"
     
-    if not verify_password(db["users"][username]["password"], password):
+    if not verify_password(stored_hash, password):
         return False, "Invalid username or password"
     
     session_id = str(uuid.uuid4())
-    expiry = (datetime.now() + SESSION_DURATION).isoformat()
-    
-    if "sessions" not in db:
-        db["sessions"] = {}
-    
-    db["sessions"][session_id] = {
-        "username": username,
-        "expires": expiry
-    }
+    expires_at = time.time() + SESSION_DURATION.total_seconds()
     
-    save_user_db(db)
+    add_session(session_id, username, expires_at)
     return True, session_id
 
 # Validate session
 def validate_session(session_id):
-    db = init_user_db()
-    
-    if "sessions" not in db or session_id not in db["sessions"]:
+    session = _session_store()["sessions"].get(session_id)
+    if session is None:
         return False, None
     
-    session = db["sessions"][session_id]
-    expiry = datetime.fromisoformat(session["expires"])
-    
-    if datetime.now() > expiry:
-        del db["sessions"][session_id]
-        save_user_db(db)
+    # Expired entries are left for the background sweep to delete
+    username, expires_at = session
+    if time.time() > expires_at:
         return False, None
     
-    return True, session["username"]
+    return True, username
 
 # Logout user
 def logout_user(session_id):
-    db = init_user_db()
-    if "sessions" in db and session_id in db["sessions"]:
-        del db["sessions"][session_id]
-        save_user_db(db)
-        return True
-    return False
+    return remove_session(session_id)
 
 # Initialize session state
 def init_auth_state():
@@ -152,8 +268,9 @@ def main():
             
             for uploaded_file in uploaded_files:
                 file_path = os.path.join(user_upload_dir, uploaded_file.name)
+                uploaded_file.seek(0)
                 with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
+                    shutil.copyfileobj(uploaded_file, f, 1024 * 1024)
                 st.success(f"Uploaded {uploaded_file.name}")
 
     else:
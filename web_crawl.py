@@ -1,30 +1,122 @@
 import asyncio
+import atexit
+import hashlib
+import logging
+import threading
+import time
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 import os
-import re
+from pathlib import Path
 from urllib.parse import urlparse
 
-async def get_scrape_content(url):
-    async with AsyncWebCrawler() as crawler:
-        result = await crawler.arun(
-            url= url,
-        )
-        print(result.markdown)
-        
-        parsed_url = urlparse(url)
-        hostname = parsed_url.netloc
-        path = parsed_url.path.strip("/").replace("/","_")
-        raw_file_name = f"{hostname}_{path}" if path else hostname
-        file = re.sub(r'[<>:"/\\|?*]', "_", raw_file_name) + ".md"
-        
-        folder_name = "data/scraped_files"
-        file_path = os.path.join(folder_name,file)
-        os.makedirs(folder_name, exist_ok=True)
-        
-        with open(file_path, "w") as md_file:
-            md_file.write(result.markdown)
-            
+# One crawler (and headless browser) is kept open and shared by every scrape.
+# Browser state belongs to the event loop that started it, so callers should
+# drive scrapes from one long-lived loop; a new loop gets a new crawler.
+_crawler = None
+_crawler_loop = None
+_crawler_lock = None
+
+# Only markdown is needed for ingestion: no images, screenshots or PDFs, and
+# navigation stops at DOMContentLoaded instead of waiting for the network
+BROWSER_CONFIG = BrowserConfig(headless=True, text_mode=True, light_mode=True)
+CRAWL_CONFIG = CrawlerRunConfig(
+    screenshot=False,
+    pdf=False,
+    word_count_threshold=10,
+    page_timeout=15000,
+    wait_until="domcontentloaded",
+    verbose=False
+)
+
+# Characters not allowed in file names on common filesystems, mapped to "_"
+_FILENAME_UNSAFE = str.maketrans({c: "_" for c in '<>:"/\\|?*'})
+
+# Scraped pages newer than this are served from disk instead of re-crawled
+SCRAPE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+def _retire_crawler(crawler, loop):
+    """Close a crawler whose loop is no longer the one scrapes run on.
+
+    The browser's pipes belong to that loop, so the close is scheduled there
+    (or the idle loop is run on a helper thread) rather than awaited here.
+    """
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(crawler.close(), loop)
+    elif not loop.is_closed():
+        threading.Thread(target=loop.run_until_complete, args=(crawler.close(),), daemon=True).start()
+    else:
+        logging.warning("Crawler's event loop is closed; its browser could not be shut down")
+
+async def get_crawler():
+    """Return the shared crawler for the running event loop, starting it on first use."""
+    global _crawler, _crawler_loop, _crawler_lock
+    loop = asyncio.get_running_loop()
+    if _crawler_loop is not loop:
+        # A new loop gets a new crawler; the old browser is shut down, not leaked
+        if _crawler is not None:
+            _retire_crawler(_crawler, _crawler_loop)
+        _crawler, _crawler_loop, _crawler_lock = None, loop, asyncio.Lock()
+    async with _crawler_lock:
+        if _crawler is None:
+            crawler = AsyncWebCrawler(config=BROWSER_CONFIG)
+            await crawler.start()
+            _crawler = crawler
+    return _crawler
+
+def _close_crawler():
+    """Shut the shared browser down at exit if its loop is still serving."""
+    if _crawler is not None and _crawler_loop.is_running():
+        asyncio.run_coroutine_threadsafe(_crawler.close(), _crawler_loop).result(timeout=10)
+
+atexit.register(_close_crawler)
+
+def _write_markdown(file_path, markdown):
+    """Save scraped markdown as UTF-8 bytes, creating the folder if needed."""
+    path = Path(file_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(markdown.encode("utf-8"))
+
+def scrape_file_path(url, output_dir="data/scraped_files"):
+    """Where a URL's markdown is stored: a readable name plus a hash of the full URL."""
+    parsed_url = urlparse(url)
+    hostname = parsed_url.netloc
+    path = parsed_url.path.strip("/").replace("/","_")
+    raw_file_name = f"{hostname}_{path}" if path else hostname
+    url_key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    file = raw_file_name.translate(_FILENAME_UNSAFE) + f"_{url_key}.md"
+    return os.path.join(output_dir,file)
+
+def _is_fresh(file_path):
+    """Whether a previously scraped file still exists and is within SCRAPE_CACHE_TTL."""
+    try:
+        scraped_at = os.stat(file_path).st_mtime
+    except FileNotFoundError:
+        return False
+    return time.time() - scraped_at < SCRAPE_CACHE_TTL
+
+async def get_scrape_content(url, output_dir="data/scraped_files"):
+    file_path = scrape_file_path(url, output_dir)
+    if _is_fresh(file_path):
         return file_path
+    
+    crawler = await get_crawler()
+    result = await crawler.arun(
+        url= url,
+        config=CRAWL_CONFIG
+    )
+    # A failed crawl must not leave an empty file that would be served as fresh
+    if not result.success or not result.markdown:
+        raise RuntimeError(f"Failed to crawl {url}: {result.error_message or 'no content returned'}")
+    logging.debug(f"Scraped {len(result.markdown)} characters of markdown from {url}")
+    
+    # Disk I/O runs on a worker thread so other scrapes on the loop keep going
+    await asyncio.to_thread(_write_markdown, file_path, result.markdown)
+        
+    return file_path
+
+async def get_scrape_contents(urls, output_dir="data/scraped_files"):
+    """Scrape several URLs concurrently on the shared crawler; returns file paths in order."""
+    return await asyncio.gather(*(get_scrape_content(url, output_dir) for url in urls))
 
 
 # asyncio.run(get_scrape_content(url))        
@@ -1,18 +1,45 @@
-import bs4
-from langchain_community.document_loaders import WebBaseLoader
+import os
+import requests
+import lxml.html
+from functools import lru_cache
+from lxml.cssselect import CSSSelector
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+# Only the post body, title and header are extracted from each page; the CSS
+# selector is compiled to XPath once here
+POST_SELECTOR = CSSSelector(".post-content, .post-title, .post-header")
+
+# One HTTP session so repeated loads reuse connections
+http_session = requests.Session()
+http_session.headers["User-Agent"] = os.getenv("USER_AGENT", "Mozilla/5.0 (compatible; PersonalKnowledgeBase)")
+
+@lru_cache(maxsize=8)
+def get_text_splitter(chunk_size, chunk_overlap):
+    """Build a splitter once per (chunk_size, chunk_overlap) and reuse it."""
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def extract_post_text(html):
+    """Text of the post sections of a page, parsed with lxml's C parser."""
+    # lxml rejects an empty document, which simply has no post text
+    if not html.strip():
+        return ""
+    root = lxml.html.fromstring(html)
+    matches = POST_SELECTOR(root)
+    # A header may contain the title; keep only outermost matches so no text repeats
+    matched = set(matches)
+    outermost = [el for el in matches if not any(ancestor in matched for ancestor in el.iterancestors())]
+    return "\n\n".join(el.text_content() for el in outermost)
+
 def load_and_chunk_web_content(url, chunk_size=1000, chunk_overlap=200):
-    loader = WebBaseLoader(
-        web_paths=[url],
-        bs_kwargs=dict(
-            parse_only=bs4.SoupStrainer(class_=("post-content", "post-title", "post-header"))
-        ),
-    )
-    docs = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    all_splits = text_splitter.split_documents(docs)
-    return all_splits
+    response = http_session.get(url, timeout=30)
+    response.raise_for_status()
+    full_text = extract_post_text(response.content)
+    if not full_text.strip():
+        return []
+    # A single page, so split its text in one pass and attach the source to each chunk
+    text_splitter = get_text_splitter(chunk_size, chunk_overlap)
+    return [Document(page_content=chunk, metadata={"source": url}) for chunk in text_splitter.split_text(full_text)]
 
 # Example usage
 if __name__ == '__main__':